@@ -0,0 +1,284 @@
+"""Benchmarks for tree backends and transform planning.
+
+Run ``python -m tree_transform.benchmark --help`` for options.  Results are
+emitted as JSON, so that they can be compared between releases.
+"""
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import platform
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+import time
+
+from tree_transform.tree_transform import (
+    DIRECTORY,
+    FILE,
+    FSTree,
+    OverlayFileStore,
+    StoreTree,
+    TreeTransform,
+    )
+
+
+def iter_layout(size, depth, fanout):
+    """Emit (path, kind) for a synthetic tree, parents before children.
+
+    The tree has size files, spread evenly across the leaf directories of a
+    tree of directories with the given depth and fan-out.  Only directories
+    that contain files are emitted.
+    """
+    seen = set()
+    for serial in range(size):
+        parts = []
+        remaining = serial
+        for level in range(depth):
+            remaining, index = divmod(remaining, fanout)
+            parts.append('d{}'.format(index))
+        path = ''
+        for part in parts:
+            path = os.path.join(path, part)
+            if path not in seen:
+                seen.add(path)
+                yield path, DIRECTORY
+        yield os.path.join(path, 'f{}'.format(serial)), FILE
+
+
+def populate(tree, layout, content):
+    """Create the entries of layout in tree."""
+    for path, kind in layout:
+        if kind == DIRECTORY:
+            tree.mkdir(path, 0o700)
+        else:
+            tree.write_content(path, 0o600, [content])
+
+
+@contextmanager
+def fs_tree(layout, content, tmpdir=None):
+    tree_root = mkdtemp(dir=tmpdir)
+    try:
+        tree = FSTree(tree_root)
+        populate(tree, layout, content)
+        yield tree
+    finally:
+        rmtree(tree_root)
+
+
+@contextmanager
+def memory_tree(layout, content, tmpdir=None):
+    tree = StoreTree()
+    populate(tree, layout, content)
+    yield tree
+
+
+@contextmanager
+def overlay_tree(layout, content, tmpdir=None):
+    """Yield a tree whose layout is in the base of an empty overlay."""
+    base = StoreTree()
+    populate(base, layout, content)
+    yield StoreTree(file_store=OverlayFileStore(base.readonly_version()))
+
+
+# The tree backends to benchmark, by name.
+BACKENDS = {
+    'fs': fs_tree,
+    'memory': memory_tree,
+    'overlay': overlay_tree,
+    }
+
+
+def timed(func):
+    """Return the wall-clock time taken to run func, in seconds."""
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def bench_tree(tree, layout, content):
+    """Time the basic operations of tree on the entries of layout.
+
+    Emits (operation, count, seconds).  The operations modify the tree, and
+    leave it empty.
+    """
+    files = [path for path, kind in layout if kind == FILE]
+    top_dirs = [path for path, kind in layout
+                if kind == DIRECTORY and os.sep not in path]
+
+    def iter_subpaths():
+        for path in top_dirs:
+            for subpath in tree.iter_subpaths(path):
+                pass
+
+    def read_content():
+        for path in files:
+            for chunk in tree.read_content(path):
+                pass
+
+    def write_content():
+        for path in files:
+            tree.write_content(path, 0o600, [content])
+
+    renamed_dirs = [path + '-renamed' for path in top_dirs]
+
+    def rename():
+        for path, new_path in zip(top_dirs, renamed_dirs):
+            tree.rename(path, new_path)
+
+    def remove():
+        for path in renamed_dirs:
+            tree.rmtree(path)
+
+    yield 'iter_subpaths', len(layout), timed(iter_subpaths)
+    yield 'read_content', len(files), timed(read_content)
+    yield 'write_content', len(files), timed(write_content)
+    yield 'rename', len(top_dirs), timed(rename)
+    yield 'rmtree', len(layout), timed(remove)
+
+
+def bulk_create(tt, layout, content):
+    """Create a new file alongside every existing file."""
+    files = [path for path, kind in layout if kind == FILE]
+    parent_ids = tt.acquire_existing_ids(
+        os.path.dirname(path) for path in files)
+    for path, parent_id in zip(files, parent_ids):
+        tt.create_file('new-' + os.path.basename(path), parent_id, [content])
+    return len(files)
+
+
+def deep_rename(tt, layout, content):
+    """Rename every file, which are the deepest entries."""
+    files = [path for path, kind in layout if kind == FILE]
+    for file_id in tt.acquire_existing_ids(files):
+        tt.set_name_info(file_id, tt.get_parent(file_id),
+                         tt.get_name(file_id) + '-renamed')
+    return len(files)
+
+
+def mass_delete(tt, layout, content):
+    """Delete every file."""
+    files = [path for path, kind in layout if kind == FILE]
+    for file_id in tt.acquire_existing_ids(files):
+        tt.delete(file_id)
+    return len(files)
+
+
+# The transform scenarios to benchmark, by name.
+SCENARIOS = {
+    'bulk_create': bulk_create,
+    'deep_rename': deep_rename,
+    'mass_delete': mass_delete,
+    }
+
+
+def bench_transform(tree, layout, content, scenario):
+    """Time the phases of a transform of tree.
+
+    Emits (phase, count, seconds), where count is the number of entries
+    changed by the scenario.
+    """
+    tt = TreeTransform(tree, write=False)
+    with tt:
+        start = time.perf_counter()
+        changed = scenario(tt, layout, content)
+        stage_time = time.perf_counter() - start
+        renames = []
+        plan_time = timed(lambda: renames.extend(tt.iter_renames()))
+        apply_time = timed(lambda: tree.apply_renames(renames))
+        start = time.perf_counter()
+    cleanup_time = time.perf_counter() - start
+    yield 'stage', changed, stage_time
+    yield 'plan', changed, plan_time
+    yield 'apply', changed, apply_time
+    yield 'cleanup', changed, cleanup_time
+
+
+def run_benchmarks(size, depth, fanout, file_size=1024, backends=None,
+                   scenarios=None, repeat=1, tmpdir=None):
+    """Run the benchmarks, returning their results as JSON-ready data.
+
+    Each benchmark is run repeat times on a freshly-built tree, and the
+    fastest time is reported.
+    """
+    if backends is None:
+        backends = sorted(BACKENDS)
+    if scenarios is None:
+        scenarios = sorted(SCENARIOS)
+    layout = list(iter_layout(size, depth, fanout))
+    content = b'x' * file_size
+    best = {}
+    counts = {}
+
+    def record(key, measurements):
+        for operation, count, seconds in measurements:
+            op_key = key + (operation,)
+            counts[op_key] = count
+            best[op_key] = min(seconds, best.get(op_key, seconds))
+
+    for iteration in range(repeat):
+        for backend in backends:
+            make_tree = BACKENDS[backend]
+            with make_tree(layout, content, tmpdir) as tree:
+                record((backend, 'tree'),
+                       bench_tree(tree, layout, content))
+            for name in scenarios:
+                with make_tree(layout, content, tmpdir) as tree:
+                    record((backend, name), bench_transform(
+                        tree, layout, content, SCENARIOS[name]))
+    results = []
+    for key in sorted(best):
+        backend, benchmark, operation = key
+        results.append({
+            'backend': backend, 'benchmark': benchmark,
+            'operation': operation, 'count': counts[key],
+            'seconds': best[key],
+            })
+    return {
+        'parameters': {
+            'size': size, 'depth': depth, 'fanout': fanout,
+            'file_size': file_size, 'repeat': repeat,
+            },
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1000,
+                        help='The number of files in the synthetic tree.')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='The depth of directories containing files.')
+    parser.add_argument('--fanout', type=int, default=10,
+                        help='The number of subdirectories per directory.')
+    parser.add_argument('--file-size', type=int, default=1024,
+                        help='The size of each file, in bytes.')
+    parser.add_argument('--backend', action='append', dest='backends',
+                        choices=sorted(BACKENDS),
+                        help='A backend to benchmark (default: all).')
+    parser.add_argument('--scenario', action='append', dest='scenarios',
+                        choices=sorted(SCENARIOS),
+                        help='A transform scenario to benchmark'
+                        ' (default: all).')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='The number of runs to take the fastest of.')
+    parser.add_argument('--tmpdir',
+                        help='The directory to build FS trees in.')
+    parser.add_argument('--output', help='The file to write JSON to'
+                        ' (default: stdout).')
+    args = parser.parse_args(argv)
+    result = run_benchmarks(args.size, args.depth, args.fanout,
+                            args.file_size, args.backends, args.scenarios,
+                            args.repeat, args.tmpdir)
+    if args.output is None:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(result, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
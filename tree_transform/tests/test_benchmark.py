@@ -0,0 +1,58 @@
+import json
+import os
+from unittest import TestCase
+
+from tree_transform.benchmark import (
+    iter_layout,
+    main,
+    run_benchmarks,
+    )
+from tree_transform.tests.test_tree_transform import temp_dir
+from tree_transform.tree_transform import (
+    DIRECTORY,
+    FILE,
+    )
+
+
+class TestIterLayout(TestCase):
+
+    def test_layout(self):
+        self.assertEqual([
+            ('d0', DIRECTORY), ('d0/d0', DIRECTORY), ('d0/d0/f0', FILE),
+            ('d1', DIRECTORY), ('d1/d0', DIRECTORY), ('d1/d0/f1', FILE),
+            ('d0/d1', DIRECTORY), ('d0/d1/f2', FILE),
+            ('d1/d1', DIRECTORY), ('d1/d1/f3', FILE),
+            ('d0/d0/f4', FILE),
+            ], list(iter_layout(5, 2, 2)))
+
+    def test_flat(self):
+        self.assertEqual([('f0', FILE), ('f1', FILE)],
+                         list(iter_layout(2, 0, 2)))
+
+
+class TestRunBenchmarks(TestCase):
+
+    def test_run_benchmarks(self):
+        result = run_benchmarks(6, 2, 2, file_size=3)
+        self.assertEqual({'size': 6, 'depth': 2, 'fanout': 2, 'file_size': 3,
+                          'repeat': 1}, result['parameters'])
+        keys = set((r['backend'], r['benchmark'], r['operation'])
+                   for r in result['results'])
+        self.assertIn(('fs', 'tree', 'rmtree'), keys)
+        self.assertIn(('memory', 'deep_rename', 'plan'), keys)
+        self.assertIn(('overlay', 'mass_delete', 'apply'), keys)
+        self.assertEqual(3 * (5 + 3 * 4), len(keys))
+        for entry in result['results']:
+            self.assertGreaterEqual(entry['seconds'], 0)
+
+    def test_main(self):
+        with temp_dir() as output_dir:
+            output = os.path.join(output_dir, 'result.json')
+            main(['--size', '3', '--repeat', '1', '--backend', 'memory',
+                  '--scenario', 'mass_delete', '--output', output])
+            with open(output) as result_file:
+                result = json.load(result_file)
+        self.assertEqual(
+            ['apply', 'cleanup', 'iter_subpaths', 'plan', 'read_content',
+             'rename', 'rmtree', 'stage', 'write_content'],
+            sorted(r['operation'] for r in result['results']))
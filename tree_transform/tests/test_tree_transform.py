@@ -1,21 +1,40 @@
 from contextlib import contextmanager
+import errno
 import os
 from shutil import rmtree
 from tempfile import mkdtemp
 from unittest import TestCase
+from unittest.mock import patch
 
 from tree_transform.tree_transform import (
+    BackgroundCleaner,
+    ContentAddressedFileStore,
+    copy_fd,
+    DIRECTORY,
+    FILE,
     FSTree,
     InactiveTransform,
     IsDirectory,
+    iter_rename_batches,
+    MemoryBlobStore,
     MemoryFileStore,
+    MetricsCollector,
+    NameTable,
     NotPending,
     NoParent,
     NoSuchFile,
+    ObservedTree,
     OverlayFileStore,
     ParentNotDir,
+    PathSet,
+    ReadOnlyFSTree,
+    ShardedStaging,
+    SpillingBlobStore,
+    SpillingFileStore,
+    StatCache,
     StoreTree,
     TreeTransform,
+    write_chunks,
     )
 
 
@@ -44,6 +63,41 @@ class ReadOnlyStoreTestMixin:
             with self.assertRaises(IsDirectory):
                 self.actual_tree(tree).read_content('foo')
 
+    def test_iter_content(self):
+        with self.setup_tree() as tree:
+            tree.write_content('foo', 0o600, [b'hello', b' world'])
+            tree.write_content('empty', 0o600, [])
+            actual = self.actual_tree(tree)
+            self.assertEqual([b'hell', b'o wo', b'rld'],
+                             list(actual.iter_content('foo', 4)))
+            self.assertEqual([b'hello world'],
+                             list(actual.iter_content('foo')))
+            self.assertEqual([], list(actual.iter_content('empty')))
+
+    def test_iter_content_no_file(self):
+        with self.setup_tree() as tree:
+            with self.assertRaises(NoSuchFile):
+                self.actual_tree(tree).iter_content('foo')
+
+    def test_iter_content_directory(self):
+        with self.setup_tree() as tree:
+            tree.mkdir('foo', 0o700)
+            with self.assertRaises(IsDirectory):
+                self.actual_tree(tree).iter_content('foo')
+
+    def test_map_content(self):
+        with self.setup_tree() as tree:
+            tree.write_content('foo', 0o600, [b'hello'])
+            tree.write_content('empty', 0o600, [])
+            actual = self.actual_tree(tree)
+            with actual.map_content('foo') as view:
+                self.assertEqual(b'ell', view[1:4].tobytes())
+            with actual.map_content('empty') as view:
+                self.assertEqual(0, len(view))
+            with self.assertRaises(NoSuchFile):
+                with actual.map_content('bar'):
+                    pass
+
     def test_get_file_mode(self):
         with self.setup_tree() as tree:
             tree.mkdir('foo', 0o745)
@@ -52,6 +106,16 @@ class ReadOnlyStoreTestMixin:
             self.assertEqual(0o745, actual.get_file_mode('foo'))
             self.assertEqual(0o654, actual.get_file_mode('bar'))
 
+    def test_get_kind(self):
+        with self.setup_tree() as tree:
+            tree.mkdir('foo', 0o700)
+            tree.write_content('bar', 0o600, [b'baz'])
+            actual = self.actual_tree(tree)
+            self.assertEqual(DIRECTORY, actual.get_kind('foo'))
+            self.assertEqual(FILE, actual.get_kind('bar'))
+            with self.assertRaises(NoSuchFile):
+                actual.get_kind('qux')
+
     def test_iter_subppaths(self):
         with self.setup_tree() as setup:
             actual = self.actual_tree(setup)
@@ -65,6 +129,24 @@ class ReadOnlyStoreTestMixin:
             self.assertCountEqual(['dir1', 'dir1/dir2', 'dir1/file1'],
                                   actual.iter_subpaths('dir1'))
 
+    def test_iter_entries(self):
+        with self.setup_tree() as setup:
+            actual = self.actual_tree(setup)
+            self.assertCountEqual([], actual.iter_entries('dir1'))
+            setup.mkdir('dir1', 0o750)
+            setup.mkdir('dir1/dir2', 0o700)
+            setup.write_content('dir1/file1', 0o640, [b'hello'])
+            setup.write_content('dir1/dir2/file2', 0o600, [b'world'])
+            self.assertCountEqual([
+                ('dir1', DIRECTORY, 0o750),
+                ('dir1/dir2', DIRECTORY, 0o700),
+                ('dir1/file1', FILE, 0o640),
+                ('dir1/dir2/file2', FILE, 0o600),
+                ], actual.iter_entries('dir1'))
+            self.assertCountEqual(
+                actual.iter_subpaths('dir1'),
+                [path for path, kind, mode in actual.iter_entries('dir1')])
+
     def test_ignore_non_parent(self):
         with self.setup_tree() as setup:
             actual = self.actual_tree(setup)
@@ -99,6 +181,15 @@ class StorageTestMixin(ReadOnlyStoreTestMixin):
             tree.write_content('foo', 0o600, [b'asdf'])
             self.assertEqual(b''.join(tree.read_content('foo')), b'asdf')
 
+    def test_write_content_generator(self):
+        with self.setup_tree() as tree:
+            actual = self.actual_tree(tree)
+            chunks = (b'x' * size for size in [10, 100000, 0, 5])
+            self.assertEqual(100015, actual.write_content('foo', 0o600,
+                                                          chunks))
+            self.assertEqual(b'x' * 100015,
+                             b''.join(actual.read_content('foo')))
+
     def test_rename(self):
         with self.setup_tree() as tree:
             tree.write_content('foo', 0o600, [b'asdf'])
@@ -114,6 +205,43 @@ class StorageTestMixin(ReadOnlyStoreTestMixin):
             actual.rename('foo', 'bar/foo')
             self.assertEqual(b''.join(actual.read_content('bar/foo')), b'asdf')
 
+    def test_rename_with_children(self):
+        with self.setup_tree() as tree:
+            tree.mkdir('dir1', 0o700)
+            tree.write_content('dir1/foo', 0o600, [b'asdf'])
+            actual = self.actual_tree(tree)
+            actual.rename('dir1', 'dir2')
+            self.assertEqual(b''.join(actual.read_content('dir2/foo')),
+                             b'asdf')
+            with self.assertRaises(NoSuchFile):
+                actual.read_content('dir1/foo')
+
+    def test_copy_file(self):
+        with self.setup_tree() as tree:
+            tree.write_content('foo', 0o640, [b'asdf'])
+            actual = self.actual_tree(tree)
+            self.assertEqual(4, actual.copy_file('foo', 'bar'))
+            self.assertEqual(b''.join(actual.read_content('bar')), b'asdf')
+            self.assertEqual(0o640, actual.get_file_mode('bar'))
+            self.assertEqual(b''.join(actual.read_content('foo')), b'asdf')
+
+    def test_copy_file_no_file(self):
+        with self.setup_tree() as tree:
+            actual = self.actual_tree(tree)
+            with self.assertRaises(NoSuchFile):
+                actual.copy_file('foo', 'bar')
+
+    def test_copy_file_failure_keeps_target(self):
+        with self.setup_tree() as tree:
+            tree.mkdir('dir1', 0o700)
+            tree.write_content('bar', 0o600, [b'bar'])
+            actual = self.actual_tree(tree)
+            with self.assertRaises(NoSuchFile):
+                actual.copy_file('foo', 'bar')
+            with self.assertRaises(IsDirectory):
+                actual.copy_file('dir1', 'bar')
+            self.assertEqual(b'bar', b''.join(actual.read_content('bar')))
+
     def test_mkdir(self):
         with self.setup_tree() as tree:
             actual = self.actual_tree(tree)
@@ -307,6 +435,172 @@ class TestMemoryFileStore(TestCase, StoreTestMixin):
         return tree
 
 
+class TestContentAddressedFileStore(TestCase, StoreTestMixin):
+
+    @contextmanager
+    def setup_tree(self):
+        yield ContentAddressedFileStore()
+
+    def actual_tree(self, tree):
+        return tree
+
+    def test_dedupe(self):
+        store = ContentAddressedFileStore()
+        store.write_content('foo', 0o600, [b'hello'])
+        store.write_content('bar', 0o644, [b'hel', b'lo'])
+        self.assertEqual(1, len(store.blobs))
+        self.assertEqual(5, store.blobs.size)
+        self.assertEqual(0o644, store.get_file_mode('bar'))
+        store.discard('foo')
+        self.assertEqual([b'hello'], list(store.read_content('bar')))
+        store.write_content('bar', 0o644, [b'world'])
+        self.assertEqual(1, len(store.blobs))
+        self.assertEqual([b'world'], list(store.read_content('bar')))
+        store.discard('bar')
+        self.assertEqual(0, len(store.blobs))
+        self.assertEqual(0, store.blobs.size)
+
+    def test_copy_and_rename(self):
+        store = ContentAddressedFileStore()
+        store.mkdir('dir', 0o700)
+        store.write_content('dir/foo', 0o600, [b'hello'])
+        store.write_content('bar', 0o600, [b'world'])
+        self.assertEqual(5, store.copy_file('dir/foo', 'baz'))
+        self.assertEqual(2, len(store.blobs))
+        store.rename('dir/foo', 'bar')
+        self.assertEqual(1, len(store.blobs))
+        store.rename('bar', 'bar')
+        store.discard('baz')
+        self.assertEqual([b'hello'], list(store.read_content('bar')))
+        store.mkdir('bar', 0o700)
+        self.assertEqual(0, len(store.blobs))
+
+    def test_initial_content(self):
+        store = ContentAddressedFileStore({
+            'dir': (0o700, MemoryFileStore.DIRECTORY),
+            'dir/foo': (0o600, b'hello'),
+            'dir/bar': (0o600, b'hello'),
+            })
+        self.assertEqual(1, len(store.blobs))
+        self.assertCountEqual(['dir', 'dir/foo', 'dir/bar'],
+                              store.iter_subpaths('dir'))
+        self.assertEqual(DIRECTORY, store.get_kind('dir'))
+
+
+class TestContentAddressedStoreTree(TestCase, TreeTestMixin):
+
+    @contextmanager
+    def setup_tree(self):
+        file_store = ContentAddressedFileStore()
+        file_store.mkdir('', 0o700)
+        yield StoreTree(file_store=file_store)
+
+    def actual_tree(self, tree):
+        return tree
+
+
+class TestMemoryBlobStore(TestCase):
+
+    def test_refcounts(self):
+        blobs = MemoryBlobStore()
+        blob_id = blobs.add(b'hello')
+        self.assertEqual(blob_id, blobs.add(b'hello'))
+        blobs.ref(blob_id)
+        self.assertEqual(b'hello', blobs.get(blob_id))
+        self.assertEqual(5, blobs.get_size(blob_id))
+        for x in range(3):
+            self.assertEqual(1, len(blobs))
+            blobs.release(blob_id)
+        self.assertEqual(0, len(blobs))
+        with self.assertRaises(KeyError):
+            blobs.get(blob_id)
+
+
+class TestSpillingFileStore(TestCase, StoreTestMixin):
+
+    @contextmanager
+    def setup_tree(self):
+        store = SpillingFileStore(memory_budget=8)
+        try:
+            yield store
+        finally:
+            store.close()
+
+    def actual_tree(self, tree):
+        return tree
+
+    def test_spill(self):
+        with self.setup_tree() as store:
+            store.write_content('foo', 0o600, [b'hello'])
+            store.write_content('bar', 0o640, [b'world'])
+            self.assertEqual(5, store.blobs.memory_size)
+            self.assertEqual(0o600, store.get_file_mode('foo'))
+            self.assertEqual(5, store.copy_file('foo', 'baz'))
+            self.assertEqual([b'hello'], list(store.read_content('baz')))
+            self.assertEqual([b'world'], list(store.read_content('bar')))
+            self.assertEqual(10, store.blobs.size)
+
+
+class TestSpillingStoreTree(TestCase, TreeTestMixin):
+
+    @contextmanager
+    def setup_tree(self):
+        file_store = SpillingFileStore(memory_budget=8)
+        file_store.mkdir('', 0o700)
+        try:
+            yield StoreTree(file_store=file_store)
+        finally:
+            file_store.close()
+
+    def actual_tree(self, tree):
+        return tree
+
+
+class TestSpillingBlobStore(TestCase):
+
+    def test_lru(self):
+        blobs = SpillingBlobStore(memory_budget=10)
+        try:
+            hello = blobs.add(b'hello')
+            world = blobs.add(b'world')
+            self.assertEqual(b'hello', blobs.get(hello))
+            bang = blobs.add(b'!')
+            self.assertEqual([hello, bang], list(blobs._hot))
+            self.assertEqual(6, blobs.memory_size)
+            self.assertEqual(b'world', blobs.get(world))
+            self.assertEqual(5, blobs.get_size(hello))
+            self.assertEqual(11, blobs.size)
+            self.assertLessEqual(blobs.memory_size, 10)
+        finally:
+            blobs.close()
+
+    def test_oversized(self):
+        blobs = SpillingBlobStore(memory_budget=2)
+        try:
+            blob_id = blobs.add(b'hello')
+            self.assertEqual(0, blobs.memory_size)
+            self.assertEqual(b'hello', blobs.get(blob_id))
+            self.assertEqual(0, blobs.memory_size)
+        finally:
+            blobs.close()
+
+    def test_compact(self):
+        blobs = SpillingBlobStore(memory_budget=0)
+        try:
+            blob_ids = [blobs.add(str(x).encode() * 100) for x in range(4)]
+            spill_size = blobs._scratch_end
+            for blob_id in blob_ids[:2]:
+                blobs.release(blob_id)
+            self.assertEqual(2, len(blobs))
+            blobs.compact()
+            self.assertLess(blobs._scratch_end, spill_size)
+            self.assertEqual(0, blobs._garbage)
+            self.assertEqual(b'3' * 100, blobs.get(blob_ids[3]))
+            self.assertEqual(b'2' * 100, blobs.get(blob_ids[2]))
+        finally:
+            blobs.close()
+
+
 class TestOverlayFileStore(TestCase, StoreTestMixin):
 
     @contextmanager
@@ -316,6 +610,128 @@ class TestOverlayFileStore(TestCase, StoreTestMixin):
     def actual_tree(self, tree):
         return OverlayFileStore(tree)
 
+    def test_rename_subtree(self):
+        with self.setup_tree() as tree:
+            actual = self.actual_tree(tree)
+            actual.mkdir('dir', 0o700)
+            actual.write_content('dir/foo', 0o600, [b'foo'])
+            actual.write_content('dir1', 0o600, [b'dir1'])
+            actual.rename('dir', 'dir2')
+            self.assertCountEqual(['dir2', 'dir2/foo'],
+                                  actual.iter_subpaths('dir2'))
+            self.assertEqual([b'foo'], list(actual.read_content('dir2/foo')))
+            self.assertEqual([b'dir1'], list(actual.read_content('dir1')))
+
+    def test_rename_discarded(self):
+        with self.setup_tree() as tree:
+            tree.mkdir('dir', 0o700)
+            tree.write_content('dir/foo', 0o600, [b'foo'])
+            actual = self.actual_tree(tree)
+            actual.discard('dir/foo')
+            actual.rename('dir', 'dir2')
+            self.assertIn('dir2/foo', actual.overlay_content)
+            with self.assertRaises(NoSuchFile):
+                actual.read_content('dir2/foo')
+
+    def test_rename_base_subtree(self):
+        with self.setup_tree() as tree:
+            tree.mkdir('dir', 0o700)
+            tree.write_content('dir/foo', 0o600, [b'foo'])
+            actual = self.actual_tree(tree)
+            actual.rename('dir', 'dir2')
+            self.assertEqual([b'foo'], list(actual.read_content('dir2/foo')))
+            self.assertEqual(0o600, actual.get_file_mode('dir2/foo'))
+            self.assertCountEqual(['dir2', 'dir2/foo'],
+                                  actual.iter_subpaths('dir2'))
+            self.assertCountEqual([], actual.iter_subpaths('dir'))
+            with self.assertRaises(NoSuchFile):
+                actual.read_content('dir/foo')
+
+    def test_rename_nested(self):
+        with self.setup_tree() as tree:
+            tree.mkdir('dir', 0o700)
+            tree.mkdir('dir/sub', 0o700)
+            tree.write_content('dir/sub/foo', 0o600, [b'foo'])
+            actual = self.actual_tree(tree)
+            actual.rename('dir', 'dir2')
+            actual.rename('dir2/sub', 'sub2')
+            actual.rename('dir2', 'dir3')
+            self.assertEqual([b'foo'], list(actual.read_content('sub2/foo')))
+            self.assertCountEqual(['dir3'], actual.iter_subpaths('dir3'))
+            self.assertCountEqual(['sub2', 'sub2/foo'],
+                                  actual.iter_subpaths('sub2'))
+            actual.rename('sub2', 'dir3/sub3')
+            self.assertCountEqual(['dir3', 'dir3/sub3', 'dir3/sub3/foo'],
+                                  actual.iter_subpaths('dir3'))
+            self.assertEqual({'dir': 'dir3', 'dir/sub': 'dir3/sub3'},
+                             actual._back_names)
+
+    def test_rename_away_from_discarded(self):
+        with self.setup_tree() as tree:
+            tree.mkdir('b', 0o700)
+            tree.write_content('b/f', 0o600, [b'old'])
+            actual = self.actual_tree(tree)
+            actual.discard('b/f')
+            actual.discard('b')
+            actual.mkdir('c', 0o700)
+            actual.rename('c', 'b')
+            actual.rename('b', 'd')
+            self.assertCountEqual([], actual.iter_subpaths('b'))
+            self.assertCountEqual(['d'], actual.iter_subpaths('d'))
+            with self.assertRaises(NoSuchFile):
+                actual.get_kind('b')
+            with self.assertRaises(NoSuchFile):
+                actual.read_content('b/f')
+            with self.assertRaises(NoSuchFile):
+                actual.read_content('d/f')
+
+    def test_rename_over_discarded(self):
+        with self.setup_tree() as tree:
+            tree.write_content('x', 0o600, [b'x'])
+            tree.write_content('y', 0o600, [b'y'])
+            actual = self.actual_tree(tree)
+            actual.discard('y')
+            actual.rename('x', 'y')
+            self.assertEqual([b'x'], list(actual.read_content('y')))
+            self.assertCountEqual(['y'], actual.iter_subpaths('y'))
+            with self.assertRaises(NoSuchFile):
+                actual.read_content('x')
+
+    def test_rename_base_over_overlay(self):
+        with self.setup_tree() as tree:
+            tree.write_content('x', 0o600, [b'x'])
+            actual = self.actual_tree(tree)
+            actual.write_content('y', 0o600, [b'y'])
+            actual.rename('x', 'y')
+            self.assertEqual([b'x'], list(actual.read_content('y')))
+
+    def test_copy_file_discarded_source(self):
+        with self.setup_tree() as tree:
+            tree.write_content('src', 0o600, [b'src'])
+            tree.write_content('dst', 0o600, [b'dst'])
+            actual = self.actual_tree(tree)
+            actual.discard('src')
+            with self.assertRaises(NoSuchFile):
+                actual.copy_file('src', 'dst')
+            self.assertNotIn('dst', actual.overlay_content)
+            self.assertEqual([b'dst'], list(actual.read_content('dst')))
+
+    def test_iter_entries_renamed(self):
+        with self.setup_tree() as tree:
+            tree.mkdir('dir', 0o700)
+            tree.write_content('dir/foo', 0o640, [b'foo'])
+            tree.write_content('dir/bar', 0o600, [b'bar'])
+            actual = self.actual_tree(tree)
+            actual.discard('dir/bar')
+            actual.write_content('dir/baz', 0o604, [b'baz'])
+            actual.rename('dir', 'dir2')
+            self.assertCountEqual([
+                ('dir2', DIRECTORY, 0o700),
+                ('dir2/foo', FILE, 0o640),
+                ('dir2/baz', FILE, 0o604),
+                ], actual.iter_entries('dir2'))
+            self.assertCountEqual([], actual.iter_entries('dir'))
+
 
 class TestOverlayTree(TestCase, TreeTestMixin):
 
@@ -348,6 +764,476 @@ class TestFSTree(TestCase, TreeTestMixin):
     def actual_tree(self, tree):
         return tree
 
+    def test_overlay_parent_check_reads_nothing(self):
+        with self.setup_tree() as tree:
+            tree.write_content('file1', 0o600, [b'hello'])
+            tree.mkdir('dir1', 0o700)
+            overlay = StoreTree(
+                file_store=OverlayFileStore(tree.readonly_version()))
+            with patch.object(ReadOnlyFSTree, 'read_content') as read:
+                with self.assertRaises(ParentNotDir):
+                    overlay.write_content('file1/file2', 0o600, [b'world'])
+                overlay.write_content('dir1/file2', 0o600, [b'world'])
+                overlay.rename('dir1/file2', 'dir1/file3')
+            self.assertEqual([], read.mock_calls)
+
+    def test_iter_entries_symlinks(self):
+        with self.setup_tree() as tree:
+            tree.mkdir('dir1', 0o700)
+            tree.write_content('file1', 0o640, [b'hello'])
+            os.symlink('dir1', tree.full_path('link-dir'))
+            os.symlink('file1', tree.full_path('link-file'))
+            os.symlink('missing', tree.full_path('link-missing'))
+            entries = {path: (kind, mode) for path, kind, mode
+                       in tree.iter_entries('')}
+            self.assertCountEqual(
+                ['.', 'dir1', 'file1', 'link-file', 'link-missing'], entries)
+            self.assertEqual((FILE, 0o640), entries['link-file'])
+            self.assertEqual(FILE, entries['link-missing'][0])
+            self.assertCountEqual(entries, tree.iter_subpaths(''))
+
+
+class TestCachedFSTree(TestCase, TreeTestMixin):
+
+    @contextmanager
+    def setup_tree(self):
+        with temp_dir() as tree_root:
+            yield FSTree(tree_root, stat_cache=StatCache())
+
+    def actual_tree(self, tree):
+        return tree
+
+    def test_cached(self):
+        with self.setup_tree() as tree:
+            tree.write_content('file1', 0o600, [b'hello'])
+            self.assertEqual(0o600, tree.get_file_mode('file1'))
+            with patch('os.stat') as os_stat:
+                self.assertEqual(0o600, tree.get_file_mode('file1'))
+                self.assertEqual(FILE, tree.get_kind('./file1'))
+            self.assertEqual([], os_stat.mock_calls)
+
+    def test_shared_with_subtrees(self):
+        with self.setup_tree() as tree:
+            tree.mkdir('dir1', 0o700)
+            tree.write_content('dir1/file1', 0o600, [b'hello'])
+            subtree = tree.make_subtree('dir1')
+            readonly = tree.readonly_version()
+            self.assertEqual(0o600, readonly.get_file_mode('dir1/file1'))
+            subtree.write_content('file1', 0o640, [b'hello'])
+            os.chmod(tree.full_path('dir1/file1'), 0o640)
+            self.assertEqual(0o640, readonly.get_file_mode('dir1/file1'))
+
+    def test_invalidate_renamed_subtree(self):
+        with self.setup_tree() as tree:
+            tree.mkdir('dir1', 0o700)
+            tree.mkdir('dir2', 0o700)
+            tree.write_content('dir1/file1', 0o600, [b'hello'])
+            self.assertEqual(FILE, tree.get_kind('dir1/file1'))
+            tree.rename('dir1', 'dir3')
+            with self.assertRaises(NoSuchFile):
+                tree.get_kind('dir1/file1')
+            tree.rename('dir2', 'dir1')
+            with self.assertRaises(NoSuchFile):
+                tree.get_kind('dir1/file1')
+
+    def test_validated_on_read(self):
+        with self.setup_tree() as tree:
+            tree.write_content('file1', 0o600, [b'hello'])
+            self.assertEqual(0o600, tree.get_file_mode('file1'))
+            full_path = tree.full_path('file1')
+            os.unlink(full_path)
+            with open(full_path, 'wb') as f:
+                f.write(b'hello world')
+            os.chmod(full_path, 0o640)
+            self.assertEqual(0o600, tree.get_file_mode('file1'))
+            tree.read_content('file1')
+            self.assertEqual(0o640, tree.get_file_mode('file1'))
+
+
+class TestStatCache(TestCase):
+
+    def test_lru(self):
+        cache = StatCache(max_entries=2)
+        cache.add('a', os.stat('.'))
+        cache.add('b', os.stat('.'))
+        cache.get('a')
+        cache.add('c', os.stat('.'))
+        self.assertEqual(2, len(cache))
+        self.assertIsNot(None, cache.get('a'))
+        self.assertIs(None, cache.get('b'))
+        self.assertIsNot(None, cache.get('c'))
+
+    def test_invalidate(self):
+        cache = StatCache()
+        for key in ['/a', '/a/b', '/a/b/c', '/ab']:
+            cache.add(key, os.stat('.'))
+        cache.invalidate('/a')
+        self.assertEqual(1, len(cache))
+        self.assertIsNot(None, cache.get('/ab'))
+        cache.invalidate('/missing')
+        self.assertEqual(1, len(cache))
+
+    def test_validate(self):
+        cache = StatCache()
+        with temp_dir() as root:
+            cache.add('key', os.stat(root))
+            cached = cache.get('key')
+            cache.validate('key', os.stat(root))
+            self.assertIs(cached, cache.get('key'))
+            file_stat = os.stat('.')
+            cache.validate('key', file_stat)
+            self.assertIs(file_stat, cache.get('key'))
+
+
+class TestWriteChunks(TestCase):
+
+    def test_short_writes(self):
+        written = []
+
+        def short_write(fd, data):
+            written.append(bytes(data[:3]))
+            return len(written[-1])
+
+        with patch('os.write', short_write):
+            self.assertEqual(11, write_chunks(1, [b'hello', b' world'],
+                                              buffer_size=4))
+        self.assertEqual([b'hel', b'lo', b' wo', b'rld'], written)
+
+    def test_coalesce(self):
+        r, w = os.pipe()
+        try:
+            self.assertEqual(6, write_chunks(w, [b'a', b'bc', b'def'],
+                                             buffer_size=4))
+            self.assertEqual(b'abcdef', os.read(r, 100))
+        finally:
+            os.close(r)
+            os.close(w)
+
+
+class TestCopyFd(TestCase):
+
+    def check_copy(self):
+        content = b'hello' * 100000
+        with temp_dir() as root:
+            source_path = os.path.join(root, 'source')
+            target_path = os.path.join(root, 'target')
+            with open(source_path, 'wb') as source:
+                source.write(content)
+            source = os.open(source_path, os.O_RDONLY)
+            target = os.open(target_path, os.O_WRONLY | os.O_CREAT)
+            try:
+                self.assertEqual(len(content), copy_fd(source, target))
+            finally:
+                os.close(source)
+                os.close(target)
+            with open(target_path, 'rb') as target:
+                self.assertEqual(content, target.read())
+
+    def unsupported(self, *args):
+        raise OSError(errno.EXDEV, 'Unsupported')
+
+    def test_copy_fd(self):
+        self.check_copy()
+
+    def test_copy_fd_sendfile(self):
+        with patch('tree_transform.tree_transform.fcntl', None):
+            with patch('os.copy_file_range', self.unsupported):
+                self.check_copy()
+
+    def test_copy_fd_read_write(self):
+        with patch('tree_transform.tree_transform.fcntl', None):
+            with patch('os.copy_file_range', self.unsupported):
+                with patch('os.sendfile', self.unsupported):
+                    self.check_copy()
+
+
+class TestPathSet(TestCase):
+
+    def test_iter_subpaths(self):
+        paths = PathSet(['dir1', 'dir1/file1', 'dir1/dir2/file2', 'dir10'])
+        self.assertCountEqual(['dir1', 'dir1/file1', 'dir1/dir2/file2'],
+                              paths.iter_subpaths('dir1'))
+        self.assertCountEqual(['dir1/dir2/file2'],
+                              paths.iter_subpaths('dir1/dir2'))
+        self.assertCountEqual([], paths.iter_subpaths('dir'))
+
+    def test_discard(self):
+        paths = PathSet(['dir1', 'dir1/dir2/file2'])
+        paths.discard('dir1/dir2/file2')
+        self.assertNotIn('dir1/dir2/file2', paths)
+        self.assertCountEqual(['dir1'], paths.iter_subpaths('dir1'))
+        self.assertEqual({'': {'dir1'}}, paths._children)
+        paths.discard('dir1')
+        self.assertEqual(0, len(paths))
+        self.assertEqual({}, paths._children)
+
+    def test_discard_keeps_children(self):
+        paths = PathSet(['dir1', 'dir1/file1'])
+        paths.discard('dir1')
+        self.assertCountEqual(['dir1/file1'], paths.iter_subpaths('dir1'))
+        with self.assertRaises(KeyError):
+            paths.remove('dir1')
+
+
+class TestParallelFSTree(TestCase, TreeTestMixin):
+
+    @contextmanager
+    def setup_tree(self):
+        with temp_dir() as tree_root:
+            yield FSTree(tree_root, rename_workers=4)
+
+    def actual_tree(self, tree):
+        return tree
+
+    def test_make_subtree_workers(self):
+        with self.setup_tree() as tree:
+            self.assertEqual(4, tree.make_temp_tree().rename_workers)
+
+    def test_apply_transform(self):
+        with self.setup_tree() as tree:
+            for num in range(20):
+                tree.mkdir('dir{}'.format(num), 0o700)
+                tree.write_content('file{}'.format(num), 0o600,
+                                   [str(num).encode('ascii')])
+            with TreeTransform(tree) as tt:
+                root = tt.acquire_existing_id('.')
+                for num in range(20):
+                    dir_id = tt.acquire_existing_id('dir{}'.format(num))
+                    file_id = tt.acquire_existing_id('file{}'.format(num))
+                    tt.set_name_info(dir_id, root, 'moved{}'.format(num))
+                    tt.set_name_info(file_id, dir_id, 'file')
+            for num in range(20):
+                self.assertEqual(
+                    [str(num).encode('ascii')],
+                    tree.read_content('moved{}/file'.format(num)))
+
+
+class TestReadOnlyDirFdFSTree(TestCase, ReadOnlyTreeTestMixin,
+                              ReadOnlyStoreTestMixin):
+
+    @contextmanager
+    def setup_tree(self):
+        with temp_dir() as tree_root:
+            tree = FSTree(tree_root, use_dir_fd=True)
+            try:
+                yield tree
+            finally:
+                tree.close()
+
+    def actual_tree(self, tree):
+        return tree.readonly_version()
+
+
+class TestDirFdFSTree(TestCase, TreeTestMixin):
+
+    @contextmanager
+    def setup_tree(self):
+        with temp_dir() as tree_root:
+            tree = FSTree(tree_root, use_dir_fd=True)
+            try:
+                yield tree
+            finally:
+                tree.close()
+
+    def actual_tree(self, tree):
+        return tree
+
+    def test_root_renamed(self):
+        with temp_dir() as parent:
+            os.mkdir(os.path.join(parent, 'root'))
+            tree = FSTree(os.path.join(parent, 'root'), use_dir_fd=True)
+            try:
+                tree.write_content('file1', 0o600, [b'hello'])
+                with TreeTransform(tree) as tt:
+                    os.rename(os.path.join(parent, 'root'),
+                              os.path.join(parent, 'moved'))
+                    root = tt.acquire_existing_id('.')
+                    tt.create_file('file2', root, [b'world'])
+                    file1 = tt.acquire_existing_id('file1')
+                    tt.set_name_info(file1, root, 'file3')
+                self.assertEqual(['.', 'file2', 'file3'],
+                                 sorted(tree.iter_subpaths('')))
+                self.assertEqual([b'world'], tree.read_content('file2'))
+                self.assertEqual(['file2', 'file3'], sorted(
+                    os.listdir(os.path.join(parent, 'moved'))))
+            finally:
+                tree.close()
+
+
+class TestIterRenameBatches(TestCase):
+
+    def test_independent(self):
+        renames = [('a/b', 'new/1'), ('c/d', 'new/2'), ('e', 'old/3')]
+        self.assertEqual([renames], list(iter_rename_batches(renames)))
+
+    def test_dependent(self):
+        renames = [('a/b', 'new/1'), ('c/d', 'new/2'), ('a', 'new/3'),
+                   ('new/3', 'x'), ('new/1', 'x/b')]
+        self.assertEqual([renames[:2], renames[2:3], renames[3:4],
+                          renames[4:]],
+                         list(iter_rename_batches(renames)))
+
+    def test_empty(self):
+        self.assertEqual([], list(iter_rename_batches([])))
+
+
+class TestNameTable(TestCase):
+
+    def test_set_get(self):
+        table = NameTable()
+        self.assertEqual({}, table)
+        table['e-dir1/file1'] = ('e-dir1', 'file1')
+        table['e-dir1'] = ('e-.', 'dir1')
+        self.assertEqual(('e-dir1', 'file1'), table['e-dir1/file1'])
+        self.assertIn('e-dir1', table)
+        self.assertNotIn('e-.', table)
+        self.assertIs(None, table.get('e-.'))
+        with self.assertRaises(KeyError):
+            table['e-.']
+        self.assertEqual(2, len(table))
+        self.assertEqual({'e-dir1/file1': ('e-dir1', 'file1'),
+                          'e-dir1': ('e-.', 'dir1')}, dict(table.items()))
+
+    def test_other_ids(self):
+        table = NameTable()
+        table['n-0-file1'] = ('e-dir1', 'file1')
+        table['n-1-file2'] = ('n-0-file1', 'file2')
+        self.assertEqual(('n-0-file1', 'file2'), table['n-1-file2'])
+        self.assertCountEqual(['n-0-file1', 'n-1-file2'], table)
+        del table['n-0-file1']
+        self.assertNotIn('n-0-file1', table)
+        self.assertEqual(1, len(table))
+
+    def test_indexes(self):
+        table = NameTable()
+        table['e-dir1/file1'] = ('e-dir1', 'file1')
+        index = table.find_index('e-dir1/file1')
+        parent = table.get_parent_index(index)
+        self.assertEqual(parent, table.path_index(table.ROOT, 'dir1'))
+        self.assertEqual('e-dir1', table.get_id(parent))
+        self.assertEqual('dir1/file1', table.get_path(index))
+        self.assertEqual(-1, table.get_parent_index(parent))
+        self.assertEqual('file1', table.get_name(index))
+        self.assertEqual([index], list(table.iter_indexes()))
+        self.assertEqual(table.ROOT, table.index('e-.'))
+        self.assertIs(None, table.find_index('e-dir2'))
+        self.assertIs(None, table.find_index('e-dir1/file2'))
+        table.set_entry(table.index('n-0-dir2'), parent, 'dir2')
+        self.assertEqual(('e-dir1', 'dir2'), table['n-0-dir2'])
+        self.assertIs(None, table.get_path(table.index('n-0-dir2')))
+        table.remove_entry(index)
+        self.assertNotIn('e-dir1/file1', table)
+        with self.assertRaises(KeyError):
+            table.remove_entry(index)
+
+    def test_is_in_place(self):
+        table = NameTable()
+        table['e-dir1/file1'] = ('e-dir1', 'file1')
+        table['e-dir1/file2'] = ('e-dir1', 'file3')
+        table['e-dir1/file4'] = ('e-.', 'file4')
+        table['n-0-file5'] = ('e-dir1', 'file5')
+        self.assertEqual([True, False, False, False], [
+            table.is_in_place(table.find_index(file_id)) for file_id in
+            ['e-dir1/file1', 'e-dir1/file2', 'e-dir1/file4', 'n-0-file5']])
+
+
+class TestObservedTree(TestCase, TreeTestMixin):
+
+    @contextmanager
+    def setup_tree(self):
+        yield ObservedTree(StoreTree(), MetricsCollector())
+
+    def actual_tree(self, tree):
+        return tree
+
+    def test_counters(self):
+        metrics = MetricsCollector()
+        tree = ObservedTree(StoreTree(), metrics)
+        tree.mkdir('dir1', 0o700)
+        tree.write_content('dir1/file1', 0o600, [b'hello', b' world'])
+        tree.read_content('dir1/file1')
+        subtree = tree.make_subtree('dir1')
+        subtree.write_content('file2', 0o600, [b'hello'])
+        tree.apply_renames([('dir1/file1', 'file1'),
+                            ('dir1/file2', 'file2')])
+        self.assertEqual({'mkdir': 1, 'write_content': 2, 'bytes_written': 16,
+                          'read_content': 1, 'rename': 2}, metrics.counters)
+        self.assertEqual({}, metrics.timings)
+
+
+class TestMetricsCollector(TestCase):
+
+    def test_metrics(self):
+        metrics = MetricsCollector()
+        metrics.phase('plan', 0.5)
+        metrics.phase('plan', 0.25)
+        metrics.count('renames', 3)
+        metrics.count('renames')
+        self.assertEqual({'plan': 0.75}, metrics.timings)
+        self.assertEqual({'plan': 2}, metrics.phase_counts)
+        self.assertEqual({'renames': 4}, metrics.counters)
+
+
+class TestBackgroundCleaner(TestCase):
+
+    def test_submit(self):
+        with temp_dir() as tree_root:
+            tree = FSTree(tree_root)
+            tree.mkdir('dir1', 0o700)
+            tree.write_content('dir1/file1', 0o600, [b'hello'])
+            with BackgroundCleaner() as cleaner:
+                cleaner.submit(tree, 'dir1')
+            self.assertEqual([], os.listdir(tree_root))
+            self.assertEqual([], cleaner.errors)
+
+    def test_errors(self):
+        with temp_dir() as tree_root:
+            with BackgroundCleaner() as cleaner:
+                cleaner.submit(FSTree(tree_root), 'dir1')
+            self.assertEqual(1, len(cleaner.errors))
+            self.assertIsInstance(cleaner.errors[0], FileNotFoundError)
+
+    def test_reclaim(self):
+        with temp_dir() as tree_root:
+            tree = FSTree(tree_root)
+            tree.mkdtemp()
+            tree.mkdir('dir1', 0o700)
+            tree.write_content('transform-file', 0o600, [b'hello'])
+            with BackgroundCleaner() as cleaner:
+                self.assertEqual(0, cleaner.reclaim(tree))
+                self.assertEqual(1, cleaner.reclaim(tree, min_age=0))
+            self.assertCountEqual(['dir1', 'transform-file'],
+                                  os.listdir(tree_root))
+
+    def test_close_twice(self):
+        cleaner = BackgroundCleaner()
+        cleaner.close()
+        cleaner.close()
+
+
+class TestShardedStaging(TestCase):
+
+    def test_allocate(self):
+        tree = StoreTree()
+        tree.mkdir('new', 0o700)
+        staging = ShardedStaging(tree, 'new', shard_size=2)
+        paths = [staging.allocate() for x in range(9)]
+        self.assertEqual(['new/0/0/0', 'new/0/0/1', 'new/0/1/0', 'new/0/1/1',
+                          'new/1/0/0', 'new/1/0/1', 'new/1/1/0', 'new/1/1/1',
+                          'new/2/0/0'], paths)
+        self.assertCountEqual(
+            ['new', 'new/0', 'new/0/0', 'new/0/1', 'new/1', 'new/1/0',
+             'new/1/1', 'new/2', 'new/2/0'],
+            tree.iter_subpaths('new'))
+
+    def test_allocate_one_level(self):
+        tree = StoreTree()
+        tree.mkdir('new', 0o700)
+        staging = ShardedStaging(tree, 'new', shard_size=2, levels=1)
+        paths = [staging.allocate() for x in range(5)]
+        self.assertEqual(['new/0/0', 'new/0/1', 'new/1/0', 'new/1/1',
+                          'new/2/0'], paths)
+
 
 class TestTreeTransform(TestCase):
 
@@ -371,9 +1257,40 @@ class TestTreeTransform(TestCase):
     def test_get_existing_id(self):
         store_tree = StoreTree()
         tt = TreeTransform(store_tree, write=False)
+        with self.assertRaises(NotPending):
+            tt.acquire_existing_id('file1')
         with tt:
             self.assertEqual('e-file1', tt.acquire_existing_id('file1'))
 
+    def test_acquire_existing_id_ancestors(self):
+        tt = TreeTransform(StoreTree(), write=False)
+        with tt:
+            file1 = tt.acquire_existing_id('dir1//dir2/./file1')
+            self.assertEqual('e-dir1/dir2/file1', file1)
+            self.assertEqual(('e-dir1/dir2', 'file1'), tt._name_info[file1])
+            self.assertEqual(('e-dir1', 'dir2'), tt._name_info['e-dir1/dir2'])
+            self.assertEqual(('e-.', 'dir1'), tt._name_info['e-dir1'])
+            with self.assertRaisesRegex(ValueError, 'Path outside tree.'):
+                tt.acquire_existing_id('/dir1')
+
+    def test_acquire_existing_id_deep(self):
+        tt = TreeTransform(StoreTree(), write=False)
+        with tt:
+            path = '/'.join(['d'] * 5000)
+            file_id = tt.acquire_existing_id(path)
+            self.assertEqual(5000, len(tt._name_info))
+            self.assertEqual(path, tt.get_final_path(file_id))
+
+    def test_acquire_existing_ids(self):
+        tt = TreeTransform(StoreTree(), write=False)
+        with tt:
+            ids = tt.acquire_existing_ids(['dir1/file1', 'dir1/file2', '.',
+                                           'dir2'])
+            self.assertEqual(['e-dir1/file1', 'e-dir1/file2', 'e-.',
+                              'e-dir2'], ids)
+            self.assertCountEqual(['e-dir1', 'e-dir1/file1', 'e-dir1/file2',
+                                   'e-dir2'], tt._name_info)
+
     def test_make_new_id(self):
         tt = TreeTransform(StoreTree(), write=False)
         with self.assertRaises(NotPending):
@@ -432,18 +1349,63 @@ class TestTreeTransform(TestCase):
             tt.set_name_info(file1, dir1, 'file2')
             self.assertEqual(tt.get_final_path(file1), 'dir1/file2')
 
+    def test_get_final_path_invalidated(self):
+        store_tree = StoreTree()
+        with TreeTransform(store_tree, write=False) as tt:
+            root = tt.acquire_existing_id('.')
+            file1 = tt.acquire_existing_id('dir1/dir2/file1')
+            dir1 = tt._tree_path_to_id('dir1')
+            dir2 = tt._tree_path_to_id('dir1/dir2')
+            self.assertEqual('dir1/dir2/file1', tt.get_final_path(file1))
+            tt.set_name_info(dir1, root, 'dir3')
+            self.assertEqual('dir3/dir2/file1', tt.get_final_path(file1))
+            tt.set_name_info(dir2, root, 'dir4')
+            self.assertEqual('dir4/file1', tt.get_final_path(file1))
+            self.assertEqual('dir3', tt.get_final_path(dir1))
+
+    def test_get_final_path_implicit_parent(self):
+        store_tree = StoreTree()
+        with TreeTransform(store_tree, write=False) as tt:
+            root = tt.acquire_existing_id('.')
+            file1 = tt._tree_path_to_id('dir1/file1')
+            dir1 = tt._tree_path_to_id('dir1')
+            tt.set_name_info(file1, dir1, 'file1')
+            self.assertEqual('dir1/file1', tt.get_final_path(file1))
+            tt.set_name_info(dir1, root, 'dir2')
+            self.assertEqual('dir2/file1', tt.get_final_path(file1))
+
+    def test_get_final_path_deep(self):
+        store_tree = StoreTree()
+        with TreeTransform(store_tree, write=False) as tt:
+            file_id = tt.acquire_existing_id('.')
+            for depth in range(5000):
+                parent_id = file_id
+                file_id = 'e-' + '/'.join(['d'] * (depth + 1))
+                tt.set_name_info(file_id, parent_id, 'd')
+            self.assertEqual('/'.join(['d'] * 5000),
+                             tt.get_final_path(file_id))
+
+    def test_get_final_path_loop(self):
+        store_tree = StoreTree()
+        with TreeTransform(store_tree, write=False) as tt:
+            dir1 = tt.acquire_existing_id('dir1')
+            dir2 = tt.acquire_existing_id('dir1/dir2')
+            tt.set_name_info(dir1, dir2, 'dir1')
+            with self.assertRaisesRegex(ValueError, 'Parent loop.'):
+                tt.get_final_path(dir1)
+
     def test_generate_renames(self):
         store_tree = StoreTree()
         tt = TreeTransform(store_tree, write=False)
         with tt:
             file1 = tt.acquire_existing_id('file1')
             dir1 = tt._tree_path_to_id('dir1')
-            file1_path = tt._new_contents.full_path(file1)
+            file1_path = os.path.join(tt._new_staging.prefix, '0/0/0')
             tt.set_name_info(file1, dir1, 'file2')
             self.assertEqual(
                 [('file1', file1_path),
                  (file1_path, 'dir1/file2')],
-                tt.generate_renames())
+                list(tt.generate_renames()))
 
     def test_generate_renames_dir_swap(self):
         store_tree = StoreTree()
@@ -454,14 +1416,128 @@ class TestTreeTransform(TestCase):
             root = tt._tree_path_to_id('.')
             tt.set_name_info(dir1, dir2, 'dir1')
             tt.set_name_info(dir2, root, 'dir2')
-            dir1_path = tt._new_contents.full_path(dir1)
-            dir2_path = tt._new_contents.full_path(dir2)
+            dir1_path = os.path.join(tt._new_staging.prefix, '0/0/0')
+            dir2_path = os.path.join(tt._new_staging.prefix, '0/0/1')
             self.assertEqual(
                 [('dir1/dir2', dir2_path),
                  ('dir1', dir1_path),
                  (dir2_path, 'dir2'),
                  (dir1_path, 'dir2/dir1')],
-                tt.generate_renames())
+                list(tt.generate_renames()))
+
+    def test_generate_renames_unchanged(self):
+        store_tree = StoreTree()
+        tt = TreeTransform(store_tree, write=False)
+        with tt:
+            file1 = tt.acquire_existing_id('dir1/dir2/file1')
+            dir2 = tt._tree_path_to_id('dir1/dir2')
+            file1_path = os.path.join(tt._new_staging.prefix, '0/0/0')
+            tt.set_name_info(file1, dir2, 'file2')
+            self.assertEqual(
+                [('dir1/dir2/file1', file1_path),
+                 (file1_path, 'dir1/dir2/file2')],
+                list(tt.generate_renames()))
+
+    def test_generate_renames_subtree(self):
+        store_tree = StoreTree()
+        tt = TreeTransform(store_tree, write=False)
+        with tt:
+            root = tt.acquire_existing_id('.')
+            tt.acquire_existing_id('dir1/dir3/file1')
+            dir1 = tt._tree_path_to_id('dir1')
+            tt.set_name_info(dir1, root, 'dir2')
+            dir1_path = os.path.join(tt._new_staging.prefix, '0/0/0')
+            self.assertEqual([('dir1', dir1_path), (dir1_path, 'dir2')],
+                             list(tt.generate_renames()))
+
+    def test_generate_renames_subtree_parent_removed(self):
+        store_tree = StoreTree()
+        tt = TreeTransform(store_tree, write=False)
+        with tt:
+            root = tt.acquire_existing_id('.')
+            file1 = tt.acquire_existing_id('dir1/file1')
+            dir1 = tt._tree_path_to_id('dir1')
+            tt.delete(dir1)
+            tt.set_name_info(file1, root, 'file1')
+            file1_path = os.path.join(tt._new_staging.prefix, '0/0/0')
+            dir1_path = os.path.join(tt._old_staging.prefix, '0/0/0')
+            self.assertEqual([('dir1/file1', file1_path),
+                              ('dir1', dir1_path),
+                              (file1_path, 'file1')],
+                             list(tt.generate_renames()))
+
+    def test_rename_plan(self):
+        store_tree = StoreTree()
+        store_tree.mkdir('dir1', 0o700)
+        store_tree.write_content('dir1/file1', 0o600, [b'hello'])
+        with TreeTransform(store_tree, write=False) as tt:
+            root = tt.acquire_existing_id('.')
+            file1 = tt.acquire_existing_id('dir1/file1')
+            dir2 = tt.create_file('dir2', root, [b'world!'])
+            tt.copy_file(file1, root, 'file2')
+            tt.delete(tt.get_parent(file1))
+            tt.set_name_info(file1, root, 'file1')
+            plan = tt.generate_renames()
+            self.assertEqual(2, plan.removals)
+            self.assertEqual(3, plan.insertions)
+            self.assertEqual(11, plan.staged_bytes)
+            self.assertEqual(1, plan.max_depth)
+            self.assertEqual(5 * plan.RENAME_COST + 11, plan.estimated_cost)
+            self.assertEqual(5, len(plan))
+            renames = list(plan)
+            self.assertEqual(5, len(renames))
+            self.assertEqual(['dir1/file1', 'dir1'],
+                             [old for old, new in renames[:2]])
+            self.assertCountEqual(['dir2', 'file1', 'file2'],
+                                  [new for old, new in renames[2:]])
+            self.assertEqual('dir2', tt.get_final_path(dir2))
+
+    def test_rename_plan_unstaged(self):
+        store_tree = StoreTree()
+        with TreeTransform(store_tree, write=False) as tt:
+            tt.acquire_existing_id('dir1/file1')
+            plan = tt.generate_renames()
+            self.assertEqual(0, len(plan))
+            self.assertIs(None, plan.max_depth)
+            self.assertEqual(0, plan.estimated_cost)
+            tt.delete(tt.acquire_existing_id('dir1/file2'))
+            plan = tt.generate_renames()
+            self.assertEqual((1, 0, 1), (plan.removals, plan.insertions,
+                                         plan.max_depth))
+            self.assertIs(None, tt._staging)
+
+    def test_move_subtree(self):
+        store_tree = StoreTree()
+        store_tree.mkdir('dir1', 0o700)
+        store_tree.mkdir('dir1/dir3', 0o700)
+        store_tree.write_content('dir1/dir3/file1', 0o600, [b'hello'])
+        with TreeTransform(store_tree) as tt:
+            root = tt.acquire_existing_id('.')
+            file1 = tt.acquire_existing_id('dir1/dir3/file1')
+            dir3 = tt.get_parent(file1)
+            tt.set_name_info(tt.get_parent(dir3), root, 'dir2')
+            tt.create_file('file2', dir3, [b'world'])
+        self.assertEqual(b'hello',
+                         b''.join(store_tree.read_content('dir2/dir3/file1')))
+        self.assertEqual(b'world',
+                         b''.join(store_tree.read_content('dir2/dir3/file2')))
+
+    def test_iter_renames_depth_order(self):
+        store_tree = StoreTree()
+        tt = TreeTransform(store_tree, write=False)
+        with tt:
+            root = tt.acquire_existing_id('.')
+            ids = tt.acquire_existing_ids(['a/b/c', 'a/b', 'd', 'e/f'])
+            for file_id in ids:
+                tt.set_name_info(file_id, root, tt.get_name(file_id) + '2')
+            renames = tt.iter_renames()
+            self.assertEqual('a/b/c', next(renames)[0])
+            renames = list(renames)
+            removals = [old for old, new in renames[:3]]
+            self.assertEqual(['a/b', 'e/f'], sorted(removals[:2]))
+            self.assertEqual('d', removals[2])
+            insertions = [new for old, new in renames[3:]]
+            self.assertCountEqual(['c2', 'b2', 'd2', 'f2'], insertions)
 
     def test_with(self):
         store_tree = StoreTree()
@@ -470,7 +1546,7 @@ class TestTreeTransform(TestCase):
         tt = TreeTransform(store_tree)
         self.assertIs(InactiveTransform, type(tt._name_info))
         self.assertIs(InactiveTransform, type(tt.id_counter))
-        self.assertIs(None, tt._new_contents)
+        self.assertIs(None, tt._new_staging)
         with tt:
             self.assertEqual({}, tt._name_info)
             file1 = tt.acquire_existing_id('file1')
@@ -498,6 +1574,69 @@ class TestTreeTransform(TestCase):
         with self.assertRaises(NoSuchFile):
             store_tree.read_content(full_path)
 
+    def test_no_staging(self):
+        with temp_dir() as tree_root:
+            tree = FSTree(tree_root)
+            tree.mkdir('dir1', 0o700)
+            with TreeTransform(tree) as tt:
+                tt.acquire_existing_id('dir1/file1')
+                self.assertEqual(['dir1'], os.listdir(tree_root))
+                list(tt.generate_renames())
+                self.assertIs(None, tt._staging)
+            self.assertEqual(['dir1'], os.listdir(tree_root))
+
+    def test_move_nested_fs_tree(self):
+        with temp_dir() as tree_root:
+            tree = FSTree(tree_root)
+            tree.mkdir('dir1', 0o700)
+            tree.write_content('dir1/file1', 0o600, [b'hello'])
+            with TreeTransform(tree) as tt:
+                root = tt.acquire_existing_id('.')
+                file1 = tt.acquire_existing_id('dir1/file1')
+                tt.delete(tt.get_parent(file1))
+                tt.set_name_info(file1, root, 'file2')
+            self.assertEqual(['file2'], os.listdir(tree_root))
+            self.assertEqual(b'hello', b''.join(tree.read_content('file2')))
+
+    def test_observer(self):
+        metrics = MetricsCollector()
+        tree = ObservedTree(StoreTree(), metrics)
+        tree.write_content('file1', 0o600, [b'hello'])
+        with TreeTransform(tree, observer=metrics) as tt:
+            root = tt.acquire_existing_id('.')
+            tt.create_file('file2', root, [b'world'])
+            tt.create_file('file3', root, [b'!'])
+            tt.delete(tt.acquire_existing_id('file1'))
+        self.assertEqual({'enter': 1, 'create_file': 2, 'generate_renames': 1,
+                          'apply_renames': 1, 'rmtree': 1},
+                         metrics.phase_counts)
+        self.assertEqual(set(metrics.phase_counts), set(metrics.timings))
+        self.assertEqual(3, metrics.counters['renames'])
+        self.assertEqual(3, metrics.counters['rename'])
+        self.assertEqual(11, metrics.counters['bytes_written'])
+        self.assertEqual(1, metrics.counters['rmtree'])
+
+    def test_cleaner(self):
+        with temp_dir() as tree_root:
+            tree = FSTree(tree_root)
+            tree.write_content('file1', 0o600, [b'hello'])
+            with BackgroundCleaner() as cleaner:
+                with TreeTransform(tree, cleaner=cleaner) as tt:
+                    tt.delete(tt.acquire_existing_id('file1'))
+                    temp_root = tt._temp_tree.tree_root
+            self.assertEqual([], os.listdir(tree_root))
+            self.assertFalse(os.path.exists(temp_root))
+
+    def test_lazy_staging(self):
+        store_tree = StoreTree()
+        with TreeTransform(store_tree) as tt:
+            self.assertIs(None, tt._staging)
+            tt.create_file('file1', tt.acquire_existing_id('.'), [b'hello'])
+            self.assertIsNot(None, tt._staging)
+        self.assertIs(None, tt._staging)
+        self.assertCountEqual(['', 'file1'],
+                              store_tree._file_store.iter_subpaths(''))
+
     def test_with_exception(self):
         store_tree = StoreTree()
         store_tree.write_content('file1', 0o600, [b'hello'])
@@ -522,11 +1661,58 @@ class TestTreeTransform(TestCase):
         with tt:
             parent_id = tt.acquire_existing_id('.')
             file_id = tt.create_file('name1', parent_id, [b'hello'])
-            source = tt._new_contents.full_path(file_id)
+            source = os.path.join(tt._new_staging.prefix, '0/0/0')
             target = tt.get_final_path(file_id)
-            self.assertEqual(tt.generate_renames(), [(source, target)])
+            self.assertEqual([(source, target)], list(tt.generate_renames()))
         self.assertEqual(b'hello', b''.join(store_tree.read_content('name1')))
 
+    def test_create_file_fs_tree(self):
+        with temp_dir() as tree_root:
+            tree = FSTree(tree_root)
+            with TreeTransform(tree) as tt:
+                root = tt.acquire_existing_id('.')
+                tt.create_file('name1', root, iter([b'hello', b' world']))
+            self.assertEqual(b'hello world',
+                             b''.join(tree.read_content('name1')))
+            self.assertEqual(0o644, tree.get_file_mode('name1') & 0o644)
+
+    def test_copy_file(self):
+        store_tree = StoreTree()
+        store_tree.write_content('foo', 0o600, [b'hello'])
+        with TreeTransform(store_tree) as tt:
+            root = tt.acquire_existing_id('.')
+            foo = tt.acquire_existing_id('foo')
+            bar = tt.copy_file(foo, root, 'bar')
+            tt.copy_file(bar, root, 'baz')
+        for path in ['foo', 'bar', 'baz']:
+            self.assertEqual(b'hello',
+                             b''.join(store_tree.read_content(path)))
+
+    def test_copy_file_failure(self):
+        store_tree = StoreTree()
+        store_tree.mkdir('dir1', 0o700)
+        with TreeTransform(store_tree) as tt:
+            root = tt.acquire_existing_id('.')
+            with self.assertRaises(NoSuchFile):
+                tt.copy_file(tt.acquire_existing_id('foo'), root, 'bar')
+            with self.assertRaises(IsDirectory):
+                tt.copy_file(tt.acquire_existing_id('dir1'), root, 'bar')
+            self.assertEqual({}, tt._new_contents_path)
+            self.assertEqual([], [file_id for file_id in tt._name_info
+                                  if file_id.startswith('n-')])
+        self.assertCountEqual(['', 'dir1'],
+                              store_tree._file_store.iter_subpaths(''))
+
+    def test_copy_file_fs_tree(self):
+        with temp_dir() as tree_root:
+            tree = FSTree(tree_root)
+            tree.write_content('foo', 0o640, [b'hello'])
+            with TreeTransform(tree) as tt:
+                root = tt.acquire_existing_id('.')
+                tt.copy_file(tt.acquire_existing_id('foo'), root, 'bar')
+            self.assertEqual(b'hello', b''.join(tree.read_content('bar')))
+            self.assertEqual(0o640, tree.get_file_mode('bar'))
+
     def test_delete(self):
         store_tree = StoreTree()
         store_tree.write_content('foo', 0o600, [b'hello'])
@@ -1,10 +1,34 @@
+from array import array
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import errno
+import hashlib
+from io import BytesIO
 from itertools import count
+import mmap
 import os
+from queue import Queue
 import random
 from shutil import rmtree
 import stat
-from tempfile import mkdtemp
+import sys
+from tempfile import (
+    mkdtemp,
+    TemporaryFile,
+    )
+from threading import (
+    Lock,
+    Thread,
+    )
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 __metaclass__ = type
 
@@ -13,6 +37,44 @@ DIRECTORY = 'directory'
 
 FILE = 'file'
 
+# The prefix for the names of transforms' temp trees.
+TEMP_PREFIX = 'transform-'
+
+# The maximum number of entries in each directory of a staging area.
+STAGING_SHARD_SIZE = 1024
+
+# The number of levels of shard directories in a staging area.
+STAGING_SHARD_LEVELS = 2
+
+# The default maximum number of entries in a StatCache.
+STAT_CACHE_SIZE = 4096
+
+# The maximum number of directory paths a NameTable remembers the integer ids
+# of.
+NAME_TABLE_DIR_CACHE_SIZE = 1024
+
+# The default memory budget of a SpillingBlobStore, in bytes.
+SPILL_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# The minimum garbage in a spill file, in bytes, before it is compacted.
+SPILL_COMPACT_MIN = 1024 * 1024
+
+# The default size of chunks when streaming content.
+CHUNK_SIZE = 64 * 1024
+
+# The Linux ioctl for sharing a file's data blocks with another file.
+FICLONE = 0x40049409
+
+# Flags for opening directories to use as dir_fd.
+DIR_FD_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)
+
+# Whether shutil.rmtree accepts dir_fd.
+RMTREE_DIR_FD = sys.version_info >= (3, 11)
+
+# Errors indicating that a copy mechanism is unsupported for the given files.
+COPY_UNSUPPORTED = frozenset([errno.EBADF, errno.EINVAL, errno.ENOSYS,
+                              errno.EOPNOTSUPP, errno.EXDEV])
+
 
 class NoSuchFile(Exception):
     """Raised when no such file exists."""
@@ -30,6 +92,160 @@ class IsDirectory(Exception):
     """Raised when a directory is treated like a regular file."""
 
 
+def iter_file_chunks(f, chunk_size):
+    """Emit the contents of an open file in chunks, then close it."""
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def iter_bytes_chunks(content, chunk_size):
+    """Emit a bytes object in chunks."""
+    for start in range(0, len(content), chunk_size):
+        yield content[start:start + chunk_size]
+
+
+def write_all(fd, data):
+    """Write all of data to a file descriptor, retrying short writes."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def write_chunks(fd, strings, buffer_size=CHUNK_SIZE):
+    """Write an iterable of bytes to a file descriptor.
+
+    Small chunks are coalesced into writes of up to buffer_size, and larger
+    chunks are written directly, so no more than buffer_size bytes are ever
+    buffered.  Returns the number of bytes written.
+    """
+    written = 0
+    buffered = []
+    buffered_size = 0
+    for chunk in strings:
+        if buffered and buffered_size + len(chunk) > buffer_size:
+            write_all(fd, b''.join(buffered))
+            buffered = []
+            buffered_size = 0
+        if len(chunk) >= buffer_size:
+            write_all(fd, chunk)
+        else:
+            buffered.append(chunk)
+            buffered_size += len(chunk)
+        written += len(chunk)
+    if buffered:
+        write_all(fd, b''.join(buffered))
+    return written
+
+
+def _copy_range(source_fd, target_fd, offset, size):
+    """Copy from offset to size, using the fastest supported mechanism.
+
+    Returns the offset reached.
+    """
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(source_fd, target_fd,
+                                            size - offset, offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+            return offset
+        except OSError as e:
+            if e.errno not in COPY_UNSUPPORTED:
+                raise
+    os.lseek(target_fd, offset, os.SEEK_SET)
+    if hasattr(os, 'sendfile'):
+        try:
+            while offset < size:
+                copied = os.sendfile(target_fd, source_fd, offset,
+                                     size - offset)
+                if copied == 0:
+                    break
+                offset += copied
+            return offset
+        except OSError as e:
+            if e.errno not in COPY_UNSUPPORTED:
+                raise
+    os.lseek(source_fd, offset, os.SEEK_SET)
+    while offset < size:
+        chunk = os.read(source_fd, CHUNK_SIZE)
+        if not chunk:
+            break
+        write_all(target_fd, chunk)
+        offset += len(chunk)
+    return offset
+
+
+def copy_fd(source_fd, target_fd):
+    """Copy the contents of one file descriptor to another.
+
+    A reflink is tried first, so that the files can share data blocks.
+    Failing that, the data is copied within the kernel by copy_file_range or
+    sendfile, and failing that, by read and write.  Returns the number of
+    bytes copied.
+    """
+    size = os.fstat(source_fd).st_size
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(target_fd, FICLONE, source_fd)
+        except (IOError, OSError):
+            pass
+        else:
+            return size
+    return _copy_range(source_fd, target_fd, 0, size)
+
+
+@contextmanager
+def observe_phase(observer, name):
+    """Report the time taken by the body of the with statement to observer."""
+    start = time.perf_counter()
+    yield
+    observer.phase(name, time.perf_counter() - start)
+
+
+def iter_ancestors(path):
+    """Emit a path, followed by each of its ancestors."""
+    while True:
+        yield path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return
+        path = parent
+
+
+def iter_rename_batches(renames):
+    """Group a sequence of renames into batches that may run concurrently.
+
+    A rename starts a new batch if any of its paths is the same as, or an
+    ancestor or descendant of, a path in the current batch.  Applying the
+    batches in order, and the renames within each batch in any order, is
+    therefore equivalent to applying the renames in sequence.
+    """
+    batch = []
+    batch_paths = set()
+    batch_ancestors = set()
+    for rename in renames:
+        for path in rename:
+            if path in batch_ancestors or not batch_paths.isdisjoint(
+                    iter_ancestors(path)):
+                yield batch
+                batch = []
+                batch_paths = set()
+                batch_ancestors = set()
+                break
+        batch.append(rename)
+        for path in rename:
+            batch_paths.add(path)
+            batch_ancestors.update(iter_ancestors(path))
+    if len(batch) > 0:
+        yield batch
+
+
 class BaseTree:
 
     def __init__(self, tree_root):
@@ -49,25 +265,163 @@ class BaseTree:
         tree_root = self.mkdtemp()
         return self.make_subtree(tree_root)
 
+    def close(self):
+        """Release any resources held by the tree."""
+
 
 class ReadOnlyFSTree(BaseTree):
+    """Represents a read-only filesystem tree.
+
+    :param use_dir_fd: If true, keep a directory file descriptor open for
+        tree_root, and resolve paths relative to it.  This saves the kernel
+        from resolving tree_root on every operation, and keeps the tree usable
+        if tree_root is renamed.  Subtrees get descriptors of their own.  Call
+        close() to release the descriptor.
+    :param stat_cache: If supplied, a StatCache used to answer get_file_mode
+        and get_kind without touching the filesystem.  It is shared with
+        subtrees and read-only versions.  Changes made by other means than
+        this tree's FSTree methods may not be seen until the file is next
+        opened for reading, so this is only suitable where such changes are
+        rare, e.g. for planning on slow or networked filesystems.
+    """
+
+    def __init__(self, tree_root, use_dir_fd=False, stat_cache=None):
+        super(ReadOnlyFSTree, self).__init__(tree_root)
+        self._dir_fd = None
+        if use_dir_fd:
+            self._dir_fd = os.open(tree_root, DIR_FD_FLAGS)
+        self._stat_cache = stat_cache
+
+    def _tree_kwargs(self):
+        """Return the arguments for creating a similar tree.
+
+        Directory file descriptors are handled separately.
+        """
+        return {'stat_cache': self._stat_cache}
+
+    def _with_dir_fd(self, tree, path):
+        if self._dir_fd is not None:
+            tree._dir_fd = os.open(self._fd_path(path), DIR_FD_FLAGS,
+                                   dir_fd=self._dir_fd)
+        return tree
 
     def make_subtree(self, path):
-        return type(self)(self.full_path(path))
+        return self._with_dir_fd(
+            type(self)(self.full_path(path), **self._tree_kwargs()), path)
 
     def readonly_version(self):
-        return ReadOnlyFSTree(self.tree_root)
+        return self._with_dir_fd(
+            ReadOnlyFSTree(self.tree_root, stat_cache=self._stat_cache), '.')
+
+    def close(self):
+        if self._dir_fd is not None:
+            os.close(self._dir_fd)
+            self._dir_fd = None
+
+    def _fd_path(self, path):
+        """Return a path suitable for use with the tree's dir_fd."""
+        if os.path.isabs(path):
+            path = self.relpath(path)
+        if path == '':
+            return '.'
+        return path
+
+    def _resolve(self, path):
+        """Return a path and dir_fd with which to access a tree path."""
+        if self._dir_fd is None:
+            return self.full_path(path), None
+        return self._fd_path(path), self._dir_fd
+
+    def _scandir(self, path):
+        """Return an os.scandir iterator, and an fd to close after use."""
+        if self._dir_fd is None:
+            return os.scandir(self.full_path(path)), None
+        fd = os.open(self._fd_path(path), DIR_FD_FLAGS, dir_fd=self._dir_fd)
+        try:
+            return os.scandir(fd), fd
+        except BaseException:
+            os.close(fd)
+            raise
+
+    def _walk(self, path):
+        """Emit (path, DirEntry) for a directory and everything beneath it.
+
+        Parents are emitted before their children, and the directory itself
+        is emitted with None.  Paths are relative to the tree root, and built
+        from the listings, so they need no normalization.  Like os.walk,
+        symlinks to directories are skipped, and directories that cannot be
+        listed are treated as empty.
+        """
+        top = os.path.normpath(self._fd_path(path))
+        pending = [top]
+        while len(pending) > 0:
+            dir_path = pending.pop()
+            try:
+                entries, fd = self._scandir(dir_path)
+            except OSError:
+                continue
+            try:
+                with entries:
+                    if dir_path == top:
+                        yield top, None
+                    prefix = '' if dir_path == '.' else dir_path
+                    for entry in entries:
+                        entry_path = os.path.join(prefix, entry.name)
+                        if entry.is_dir():
+                            if entry.is_symlink():
+                                continue
+                            pending.append(entry_path)
+                        yield entry_path, entry
+            finally:
+                if fd is not None:
+                    os.close(fd)
 
     def iter_subpaths(self, path):
-        for root, dirs, files in os.walk(self.full_path(path)):
-            yield self.relpath(root)
-            for file_name in files:
-                yield self.relpath(os.path.join(root, file_name))
+        for entry_path, entry in self._walk(path):
+            yield entry_path
+
+    def iter_entries(self, path):
+        """Emit (path, kind, mode) for each path emitted by iter_subpaths.
+
+        kind is DIRECTORY or FILE, and mode is as from get_file_mode.  Kinds
+        come from the directory listings, so each entry costs one stat.
+        """
+        for entry_path, entry in self._walk(path):
+            if entry is None:
+                yield entry_path, DIRECTORY, self.get_file_mode(entry_path)
+                continue
+            try:
+                entry_stat = entry.stat()
+            except FileNotFoundError:
+                # A dangling symlink.
+                entry_stat = entry.stat(follow_symlinks=False)
+            kind = DIRECTORY if entry.is_dir() else FILE
+            yield entry_path, kind, stat.S_IMODE(entry_stat.st_mode)
+
+    def _cache_key(self, path):
+        return os.path.normpath(self.full_path(path))
+
+    def _stat(self, path):
+        """Stat a path, using the stat cache if there is one."""
+        if self._stat_cache is None:
+            path, dir_fd = self._resolve(path)
+            return os.stat(path, dir_fd=dir_fd)
+        key = self._cache_key(path)
+        file_stat = self._stat_cache.get(key)
+        if file_stat is None:
+            path, dir_fd = self._resolve(path)
+            file_stat = os.stat(path, dir_fd=dir_fd)
+            self._stat_cache.add(key, file_stat)
+        return file_stat
+
+    def _open(self, path):
+        resolved, dir_fd = self._resolve(path)
+
+        def opener(path, flags):
+            return os.open(path, flags, dir_fd=dir_fd)
 
-    def read_content(self, path):
-        """Read content from iterable of strings."""
         try:
-            f = open(os.path.join(self.tree_root, path), 'rb')
+            f = open(resolved, 'rb', opener=opener)
         except IOError as e:
             if e.errno == errno.ENOENT:
                 raise NoSuchFile
@@ -75,22 +429,113 @@ class ReadOnlyFSTree(BaseTree):
                 raise IsDirectory
             else:
                 raise
-        with f:
-            return f.readlines()
+        if self._stat_cache is not None:
+            # fstat is cheap, as the path is already resolved.
+            self._stat_cache.validate(self._cache_key(path),
+                                      os.fstat(f.fileno()))
+        return f
+
+    def read_content(self, path):
+        """Read content from iterable of strings."""
+        with self._open(path) as f:
+            return [f.read()]
+
+    def iter_content(self, path, chunk_size=CHUNK_SIZE):
+        """Stream content as an iterable of chunks of at most chunk_size.
+
+        The file is opened immediately, so missing files are reported here,
+        and it remains open until the iterable is exhausted.
+        """
+        return iter_file_chunks(self._open(path), chunk_size)
+
+    @contextmanager
+    def map_content(self, path):
+        """Provide content as a read-only memoryview, without copying it.
+
+        The view is backed by mmap, and is only valid within the context.
+        """
+        with self._open(path) as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files cannot be mapped.
+                yield memoryview(b'')
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    yield view
+                finally:
+                    view.release()
 
     def get_file_mode(self, path):
-        file_stat = os.stat(self.full_path(path))
-        return stat.S_IMODE(file_stat.st_mode)
+        return stat.S_IMODE(self._stat(path).st_mode)
+
+    def get_kind(self, path):
+        """Return DIRECTORY or FILE, using a single stat."""
+        try:
+            file_stat = self._stat(path)
+        except FileNotFoundError:
+            raise NoSuchFile
+        if stat.S_ISDIR(file_stat.st_mode):
+            return DIRECTORY
+        return FILE
 
 
 class FSTree(ReadOnlyFSTree):
-    """Represents a filesystem tree."""
+    """Represents a filesystem tree.
+
+    :param rename_workers: The number of threads used by apply_renames.  If
+        greater than one, independent renames are applied concurrently, which
+        helps on filesystems where each rename has high latency.
+    """
+
+    def __init__(self, tree_root, rename_workers=1, use_dir_fd=False,
+                 stat_cache=None):
+        super(FSTree, self).__init__(tree_root, use_dir_fd=use_dir_fd,
+                                     stat_cache=stat_cache)
+        self.rename_workers = rename_workers
+
+    def _tree_kwargs(self):
+        kwargs = super(FSTree, self)._tree_kwargs()
+        kwargs['rename_workers'] = self.rename_workers
+        return kwargs
+
+    def _invalidate(self, path):
+        """Drop cached stats for path and everything beneath it."""
+        if self._stat_cache is not None:
+            self._stat_cache.invalidate(self._cache_key(path))
+
+    def apply_renames(self, renames):
+        if self.rename_workers <= 1:
+            return super(FSTree, self).apply_renames(renames)
+        renames = ((self.full_path(old_path), self.full_path(new_path))
+                   for old_path, new_path in renames)
+        with ThreadPoolExecutor(self.rename_workers) as executor:
+            for batch in iter_rename_batches(renames):
+                if len(batch) == 1:
+                    self.rename(*batch[0])
+                    continue
+                old_paths, new_paths = zip(*batch)
+                for result in executor.map(self.rename, old_paths, new_paths):
+                    pass
 
     def write_content(self, path, file_mode, strings):
-        """Store content from iterable of bytes."""
+        """Store content from iterable of bytes.
+
+        The iterable is consumed incrementally.  Returns the number of bytes
+        written.
+        """
+        f = self._create(path, file_mode)
         try:
-            f = os.open(self.full_path(path), os.O_WRONLY | os.O_CREAT,
-                        file_mode)
+            return write_chunks(f, strings)
+        finally:
+            os.close(f)
+
+    def _create(self, path, file_mode):
+        self._invalidate(path)
+        path, dir_fd = self._resolve(path)
+        try:
+            return os.open(path, os.O_WRONLY | os.O_CREAT, file_mode,
+                           dir_fd=dir_fd)
         except OSError as e:
             if e.errno == errno.ENOENT:
                 raise NoParent
@@ -98,25 +543,77 @@ class FSTree(ReadOnlyFSTree):
                 raise ParentNotDir
             else:
                 raise
-        try:
-            os.write(f, b''.join(strings))
-        finally:
-            os.close(f)
+
+    def copy_file(self, source_path, target_path):
+        """Copy a file's content and mode to a new path.
+
+        Where possible, the content is shared or copied by the kernel rather
+        than passing through Python.  Returns the number of bytes copied.
+        """
+        with self._open(source_path) as source:
+            source_stat = os.fstat(source.fileno())
+            target = self._create(target_path,
+                                  stat.S_IMODE(source_stat.st_mode))
+            try:
+                return copy_fd(source.fileno(), target)
+            finally:
+                os.close(target)
 
     def mkdir(self, path, file_mode):
-        os.mkdir(self.full_path(path), file_mode)
+        self._invalidate(path)
+        path, dir_fd = self._resolve(path)
+        os.mkdir(path, file_mode, dir_fd=dir_fd)
 
     def mkdtemp(self):
-        return mkdtemp(dir=self.tree_root, prefix='transform-')
+        if self._dir_fd is None:
+            return mkdtemp(dir=self.tree_root, prefix=TEMP_PREFIX)
+        while True:
+            name = TEMP_PREFIX + ''.join(
+                random.choice('abcdefghijklmnopqrstuvwxyz') for x in range(8))
+            try:
+                os.mkdir(name, 0o700, dir_fd=self._dir_fd)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                return self.full_path(name)
+
+    def iter_temp_dirs(self, min_age=0):
+        """Emit the names of temp dirs made by mkdtemp in the tree root.
+
+        Only those not modified for at least min_age seconds are emitted, so
+        that the temp dirs of transforms still in progress can be skipped.
+        """
+        now = time.time()
+        if self._dir_fd is None:
+            entries = os.scandir(self.tree_root)
+        else:
+            entries = os.scandir(self._dir_fd)
+        with entries:
+            for entry in entries:
+                if not entry.name.startswith(TEMP_PREFIX):
+                    continue
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+                if now - mtime >= min_age:
+                    yield entry.name
 
     def rmtree(self, path):
-        rmtree(self.full_path(path))
+        self._invalidate(path)
+        if self._dir_fd is None or not RMTREE_DIR_FD:
+            rmtree(self.full_path(path))
+        else:
+            rmtree(self._fd_path(path), dir_fd=self._dir_fd)
 
     def rename(self, old_path, new_path):
-        old_path = self.full_path(old_path)
-        new_path = self.full_path(new_path)
+        self._invalidate(old_path)
+        self._invalidate(new_path)
+        old_path, dir_fd = self._resolve(old_path)
+        new_path = self._resolve(new_path)[0]
         try:
-            os.rename(old_path, new_path)
+            os.rename(old_path, new_path, src_dir_fd=dir_fd,
+                      dst_dir_fd=dir_fd)
         except OSError as e:
             if e.errno == errno.ENOENT:
                 raise NoParent
@@ -128,11 +625,146 @@ class FSTree(ReadOnlyFSTree):
 
 def only_subpaths(super_path, paths):
     """From an iterable of paths, emit only those that are subpaths."""
+    prefix = os.path.join(super_path, '')
     for path in paths:
-        if path == super_path or path.startswith(super_path + os.sep):
+        if path == super_path or path.startswith(prefix):
             yield path
 
 
+class PathSet:
+    """A set of paths that can efficiently enumerate subtrees.
+
+    Every member is linked to its parent directory, so enumerating the
+    subpaths of a path costs time proportional to the size of the subtree,
+    not the size of the set.  Ancestors of members are tracked implicitly, so
+    members do not need to have their parents in the set.
+    """
+
+    def __init__(self, paths=()):
+        self._paths = set()
+        self._children = {}
+        for path in paths:
+            self.add(path)
+
+    def __contains__(self, path):
+        return path in self._paths
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def add(self, path):
+        if path in self._paths:
+            return
+        self._paths.add(path)
+        while True:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return
+            siblings = self._children.setdefault(parent, set())
+            if path in siblings:
+                return
+            siblings.add(path)
+            path = parent
+
+    def discard(self, path):
+        if path not in self._paths:
+            return
+        self._paths.remove(path)
+        if path in self._children:
+            # Still needed as an implicit ancestor.
+            return
+        # Unlink the path, and any implicit ancestors that are now empty.
+        while True:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return
+            siblings = self._children[parent]
+            siblings.discard(path)
+            if siblings:
+                return
+            del self._children[parent]
+            if parent in self._paths:
+                return
+            path = parent
+
+    def remove(self, path):
+        if path not in self._paths:
+            raise KeyError(path)
+        self.discard(path)
+
+    def iter_subpaths(self, super_path):
+        """Emit the members that are super_path or are beneath it.
+
+        The set must not be modified while iterating.
+        """
+        pending = [super_path]
+        while pending:
+            path = pending.pop()
+            if path in self._paths:
+                yield path
+            pending.extend(self._children.get(path, ()))
+
+
+class StatCache:
+    """A bounded LRU cache of stat results, keyed by full path.
+
+    Entries are trusted until they are invalidated, or found to differ in
+    (st_ino, st_mtime_ns, st_size) from a fresh stat passed to validate.
+    It is safe to share between threads.
+
+    :param max_entries: The number of entries to keep.  The least recently
+        used entries are dropped first.
+    """
+
+    def __init__(self, max_entries=STAT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        # Cached paths, for finding those beneath an invalidated path.
+        self._paths = PathSet()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the cached stat for key, or None."""
+        with self._lock:
+            file_stat = self._entries.get(key)
+            if file_stat is not None:
+                self._entries.move_to_end(key)
+            return file_stat
+
+    def add(self, key, file_stat):
+        with self._lock:
+            self._entries[key] = file_stat
+            self._entries.move_to_end(key)
+            self._paths.add(key)
+            while len(self._entries) > self.max_entries:
+                old_key = self._entries.popitem(last=False)[0]
+                self._paths.discard(old_key)
+
+    @staticmethod
+    def _signature(file_stat):
+        return file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
+
+    def validate(self, key, file_stat):
+        """Replace the entry for key if file_stat shows it to be stale."""
+        cached = self.get(key)
+        if cached is None or (self._signature(cached) !=
+                              self._signature(file_stat)):
+            self.add(key, file_stat)
+
+    def invalidate(self, key):
+        """Drop the entries for key and any paths beneath it."""
+        with self._lock:
+            for path in list(self._paths.iter_subpaths(key)):
+                self._paths.discard(path)
+                del self._entries[path]
+
+
 class MemoryFileStore:
     """Represents a key/value file store (blob store) in memory.
 
@@ -144,27 +776,56 @@ class MemoryFileStore:
 
     def __init__(self, content):
         self._content = content
+        self._paths = PathSet(content)
 
     def iter_subpaths(self, full_path):
-        for key in only_subpaths(full_path, self._content.keys()):
-            yield key
+        return self._paths.iter_subpaths(full_path)
+
+    def iter_entries(self, full_path):
+        """Emit (path, kind, mode) for each path emitted by iter_subpaths."""
+        for path in self._paths.iter_subpaths(full_path):
+            file_mode, content = self._content[path]
+            kind = DIRECTORY if content is self.DIRECTORY else FILE
+            yield path, kind, file_mode
 
     def write_content(self, full_path, file_mode, strings):
-        """Store content from iterable of strings."""
-        self._content[full_path] = (file_mode, b''.join(strings))
+        """Store content from iterable of strings.
+
+        Returns the number of bytes written.
+        """
+        content = BytesIO()
+        for chunk in strings:
+            content.write(chunk)
+        content = content.getvalue()
+        self._content[full_path] = (file_mode, content)
+        self._paths.add(full_path)
+        return len(content)
 
     def mkdir(self, full_path, file_mode):
         self._content[full_path] = (file_mode, self.DIRECTORY)
+        self._paths.add(full_path)
 
-    def read_content(self, full_path):
-        """Access content as iterable of strings."""
+    def _get_bytes(self, full_path):
         try:
             content = self._content[full_path]
         except KeyError:
             raise NoSuchFile
         if content[1] is self.DIRECTORY:
             raise IsDirectory
-        return iter([content[1]])
+        return content[1]
+
+    def read_content(self, full_path):
+        """Access content as iterable of strings."""
+        return iter([self._get_bytes(full_path)])
+
+    def iter_content(self, full_path, chunk_size=CHUNK_SIZE):
+        """Access content as an iterable of chunks of at most chunk_size."""
+        return iter_bytes_chunks(self._get_bytes(full_path), chunk_size)
+
+    @contextmanager
+    def map_content(self, full_path):
+        """Provide content as a read-only memoryview, without copying it."""
+        yield memoryview(self._get_bytes(full_path))
 
     def get_file_mode(self, full_path):
         try:
@@ -173,11 +834,333 @@ class MemoryFileStore:
             raise NoSuchFile
         return content[0]
 
+    def get_kind(self, full_path):
+        """Return DIRECTORY or FILE, without accessing content."""
+        try:
+            content = self._content[full_path]
+        except KeyError:
+            raise NoSuchFile
+        if content[1] is self.DIRECTORY:
+            return DIRECTORY
+        return FILE
+
+    def copy_file(self, source_path, target_path):
+        """Copy content and mode to a new path, sharing the stored bytes."""
+        content = self._get_bytes(source_path)
+        self._content[target_path] = self._content[source_path]
+        self._paths.add(target_path)
+        return len(content)
+
     def discard(self, full_path):
+        self._paths.discard(full_path)
         return self._content.pop(full_path, None)
 
     def rename(self, old_path, new_path):
-        self._content[new_path] = self._content.pop(old_path)
+        """Rename a path, along with any paths beneath it."""
+        subpaths = list(self._paths.iter_subpaths(old_path))
+        if len(subpaths) == 0:
+            raise KeyError(old_path)
+        replace_l = len(old_path)
+        for key in subpaths:
+            new_key = new_path + key[replace_l:]
+            self._content[new_key] = self._content.pop(key)
+            self._paths.discard(key)
+            self._paths.add(new_key)
+
+
+class MemoryBlobStore:
+    """Reference-counted blobs in memory, identified by their content hash.
+
+    Adding content that is already present adds a reference to the existing
+    blob, and a blob is dropped when its last reference is released.
+
+    :ivar size: The total size of the blobs held, in bytes.
+    """
+
+    def __init__(self):
+        # Blob id -> [content, reference count].
+        self._blobs = {}
+        self.size = 0
+
+    def __len__(self):
+        return len(self._blobs)
+
+    @staticmethod
+    def blob_id(content):
+        return hashlib.sha256(content).digest()
+
+    def add(self, content):
+        """Add a reference to content, storing it if needed.
+
+        Returns the blob id.
+        """
+        blob_id = self.blob_id(content)
+        blob = self._blobs.get(blob_id)
+        if blob is None:
+            self._blobs[blob_id] = [content, 1]
+            self.size += len(content)
+        else:
+            blob[1] += 1
+        return blob_id
+
+    def ref(self, blob_id):
+        """Add a reference to an existing blob."""
+        self._blobs[blob_id][1] += 1
+
+    def release(self, blob_id):
+        """Release a reference to a blob, dropping it if it was the last."""
+        blob = self._blobs[blob_id]
+        blob[1] -= 1
+        if blob[1] == 0:
+            del self._blobs[blob_id]
+            self.size -= len(blob[0])
+
+    def get(self, blob_id):
+        return self._blobs[blob_id][0]
+
+    def get_size(self, blob_id):
+        return len(self._blobs[blob_id][0])
+
+
+class SpillingBlobStore:
+    """Reference-counted blobs within a memory budget.
+
+    Recently used blobs are kept in memory, up to memory_budget bytes.  Less
+    recently used blobs are compressed and spilled to an anonymous scratch
+    file, from which they are read back when used.  Blob metadata, including
+    reference counts and sizes, is always kept in memory.
+
+    Space in the scratch file is reclaimed by compacting it when the dropped
+    blobs in it outweigh the live ones.  Call close() to release the file.
+
+    :param memory_budget: The maximum size of the blobs kept in memory.
+    :param scratch_dir: The directory for the scratch file, by default the
+        system temp dir.
+    :param compress_level: The zlib compression level for spilled blobs.
+    :ivar size: The total size of the blobs held, in bytes.
+    :ivar memory_size: The total size of the blobs held in memory, in bytes.
+    """
+
+    def __init__(self, memory_budget=SPILL_MEMORY_BUDGET, scratch_dir=None,
+                 compress_level=1):
+        self.memory_budget = memory_budget
+        self.scratch_dir = scratch_dir
+        self.compress_level = compress_level
+        # Blob id -> [reference count, size, (offset, length) or None].
+        self._blobs = {}
+        # Blob id -> content, least recently used first.
+        self._hot = OrderedDict()
+        self._scratch = None
+        self._scratch_end = 0
+        # The length of dropped blobs in the scratch file.
+        self._garbage = 0
+        self.size = 0
+        self.memory_size = 0
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def close(self):
+        if self._scratch is not None:
+            self._scratch.close()
+            self._scratch = None
+
+    def add(self, content):
+        """Add a reference to content, storing it if needed.
+
+        Returns the blob id.
+        """
+        blob_id = MemoryBlobStore.blob_id(content)
+        blob = self._blobs.get(blob_id)
+        if blob is not None:
+            blob[0] += 1
+            return blob_id
+        self._blobs[blob_id] = [1, len(content), None]
+        self.size += len(content)
+        self._cache(blob_id, content)
+        return blob_id
+
+    def ref(self, blob_id):
+        """Add a reference to an existing blob."""
+        self._blobs[blob_id][0] += 1
+
+    def release(self, blob_id):
+        """Release a reference to a blob, dropping it if it was the last."""
+        blob = self._blobs[blob_id]
+        blob[0] -= 1
+        if blob[0] != 0:
+            return
+        del self._blobs[blob_id]
+        self.size -= blob[1]
+        content = self._hot.pop(blob_id, None)
+        if content is not None:
+            self.memory_size -= len(content)
+        if blob[2] is not None:
+            self._garbage += blob[2][1]
+            if self._garbage > max(SPILL_COMPACT_MIN,
+                                   self._scratch_end - self._garbage):
+                self.compact()
+
+    def get(self, blob_id):
+        blob = self._blobs[blob_id]
+        content = self._hot.get(blob_id)
+        if content is not None:
+            self._hot.move_to_end(blob_id)
+            return content
+        content = zlib.decompress(self._read_spilled(blob[2]))
+        self._cache(blob_id, content)
+        return content
+
+    def get_size(self, blob_id):
+        return self._blobs[blob_id][1]
+
+    def _cache(self, blob_id, content):
+        """Keep content in memory, spilling others to stay in budget."""
+        self._hot[blob_id] = content
+        self.memory_size += len(content)
+        while self.memory_size > self.memory_budget:
+            old_id, old_content = self._hot.popitem(last=False)
+            self.memory_size -= len(old_content)
+            old_blob = self._blobs[old_id]
+            # Blobs read back from the scratch file are already spilled.
+            if old_blob[2] is None:
+                old_blob[2] = self._spill(
+                    zlib.compress(old_content, self.compress_level))
+
+    def _spill(self, data):
+        """Append data to the scratch file, returning (offset, length)."""
+        if self._scratch is None:
+            self._scratch = TemporaryFile(dir=self.scratch_dir)
+        location = (self._scratch_end, len(data))
+        self._scratch.seek(self._scratch_end)
+        self._scratch.write(data)
+        self._scratch_end += len(data)
+        return location
+
+    def _read_spilled(self, location):
+        offset, length = location
+        self._scratch.seek(offset)
+        return self._scratch.read(length)
+
+    def compact(self):
+        """Rewrite the scratch file without the space of dropped blobs."""
+        old_scratch = self._scratch
+        if old_scratch is None:
+            return
+        spilled = [blob for blob in self._blobs.values()
+                   if blob[2] is not None]
+        spilled.sort(key=lambda blob: blob[2][0])
+        self._scratch = None
+        self._scratch_end = 0
+        self._garbage = 0
+        try:
+            for blob in spilled:
+                old_scratch.seek(blob[2][0])
+                blob[2] = self._spill(old_scratch.read(blob[2][1]))
+        finally:
+            old_scratch.close()
+
+
+class ContentAddressedFileStore(MemoryFileStore):
+    """A MemoryFileStore that keeps each distinct content only once.
+
+    Paths map to the ids of blobs in a blob store, so identical contents
+    under many paths share one blob.  Renaming and discarding only update the
+    path map and reference counts.
+
+    :param content: Initial content, as for MemoryFileStore.  It is copied
+        into the store.
+    :param blobs: The blob store, by default a new MemoryBlobStore.
+    """
+
+    def __init__(self, content=None, blobs=None):
+        super(ContentAddressedFileStore, self).__init__({})
+        if blobs is None:
+            blobs = MemoryBlobStore()
+        self.blobs = blobs
+        if content is not None:
+            for full_path, (file_mode, data) in content.items():
+                if data is self.DIRECTORY:
+                    self.mkdir(full_path, file_mode)
+                else:
+                    self.write_content(full_path, file_mode, [data])
+
+    def _release_entry(self, entry):
+        if entry is not None and entry[1] is not self.DIRECTORY:
+            self.blobs.release(entry[1])
+
+    def write_content(self, full_path, file_mode, strings):
+        """Store content from iterable of strings, sharing identical blobs.
+
+        Returns the number of bytes written.
+        """
+        content = BytesIO()
+        for chunk in strings:
+            content.write(chunk)
+        content = content.getvalue()
+        blob_id = self.blobs.add(content)
+        self._release_entry(self._content.get(full_path))
+        self._content[full_path] = (file_mode, blob_id)
+        self._paths.add(full_path)
+        return len(content)
+
+    def mkdir(self, full_path, file_mode):
+        self._release_entry(self._content.get(full_path))
+        super(ContentAddressedFileStore, self).mkdir(full_path, file_mode)
+
+    def _get_bytes(self, full_path):
+        blob_id = super(ContentAddressedFileStore, self)._get_bytes(full_path)
+        return self.blobs.get(blob_id)
+
+    def copy_file(self, source_path, target_path):
+        """Copy content and mode to a new path, sharing the blob."""
+        # The base class checks the source, and provides the blob id.
+        blob_id = super(ContentAddressedFileStore, self)._get_bytes(
+            source_path)
+        self.blobs.ref(blob_id)
+        self._release_entry(self._content.get(target_path))
+        self._content[target_path] = self._content[source_path]
+        self._paths.add(target_path)
+        return self.blobs.get_size(blob_id)
+
+    def discard(self, full_path):
+        entry = super(ContentAddressedFileStore, self).discard(full_path)
+        self._release_entry(entry)
+        return entry
+
+    def rename(self, old_path, new_path):
+        """Rename a path, along with any paths beneath it."""
+        replace_l = len(old_path)
+        replaced = []
+        for key in self._paths.iter_subpaths(old_path):
+            new_key = new_path + key[replace_l:]
+            if new_key != key:
+                replaced.append(self._content.get(new_key))
+        super(ContentAddressedFileStore, self).rename(old_path, new_path)
+        for entry in replaced:
+            self._release_entry(entry)
+
+
+class SpillingFileStore(ContentAddressedFileStore):
+    """A ContentAddressedFileStore that keeps content within a memory budget.
+
+    Content beyond the budget is spilled to a compressed scratch file by a
+    SpillingBlobStore, while paths, modes and kinds stay in memory, so only
+    reading cold content touches the disk.  Call close() to release the
+    scratch file.
+
+    :param content: Initial content, as for MemoryFileStore.
+    :param memory_budget: The maximum size of the content kept in memory.
+    :param scratch_dir: The directory for the scratch file.
+    """
+
+    def __init__(self, content=None, memory_budget=SPILL_MEMORY_BUDGET,
+                 scratch_dir=None):
+        super(SpillingFileStore, self).__init__(
+            content, SpillingBlobStore(memory_budget, scratch_dir))
+
+    def close(self):
+        self.blobs.close()
 
 
 class OverlayFileStore:
@@ -185,16 +1168,87 @@ class OverlayFileStore:
     def __init__(self, base):
         self.base = base
         self.overlay = MemoryFileStore({})
-        self.overlay_content = set()
+        self.overlay_content = PathSet()
+        # Renamed subtrees, as current path -> base path.
         self.renames = {}
+        self._renamed = PathSet()
+        # The inverse of renames, as base path -> current path.
+        self._back_names = {}
+        # Current paths beneath which base content is hidden, except where a
+        # deeper rename exposes it.
+        self._opaque = PathSet()
+
+    @staticmethod
+    def _map_path(path, mapping):
+        """Map a path using its nearest mapped ancestor (or itself)."""
+        prefix = path
+        while True:
+            mapped = mapping.get(prefix)
+            if mapped is not None:
+                return mapped + path[len(prefix):]
+            parent = os.path.dirname(prefix)
+            if parent == prefix:
+                return path
+            prefix = parent
+
+    def _forward_path(self, current_path):
+        """Map a current path to a base path, ignoring back names.
+
+        None is returned if the current path is beneath an opaque path.
+        """
+        prefix = current_path
+        while True:
+            mapped = self.renames.get(prefix)
+            if mapped is not None:
+                return mapped + current_path[len(prefix):]
+            if prefix in self._opaque:
+                return None
+            parent = os.path.dirname(prefix)
+            if parent == prefix:
+                return current_path
+            prefix = parent
 
     def _base_path(self, current_path):
-        return self.renames.get(current_path, current_path)
+        """Return the base path for a current path.
 
-    def _current_paths(self, paths):
-        back_names = dict((v, k) for k, v in self.renames.items())
-        for path in paths:
-            yield back_names.get(path, path)
+        None is returned if the base path has been renamed elsewhere, or is
+        hidden.
+        """
+        base_path = self._forward_path(current_path)
+        if base_path is None:
+            return None
+        if self._map_path(base_path, self._back_names) != current_path:
+            return None
+        return base_path
+
+    def _current_path(self, base_path):
+        """Return the current path for a base path.
+
+        None is returned if another base path has been renamed over it.
+        """
+        current_path = self._map_path(base_path, self._back_names)
+        if self._forward_path(current_path) != base_path:
+            return None
+        return current_path
+
+    def _require_base_path(self, current_path):
+        base_path = self._base_path(current_path)
+        if base_path is None:
+            raise NoSuchFile
+        return base_path
+
+    def _add_rename(self, current_path, base_path):
+        self._opaque.discard(current_path)
+        self.renames[current_path] = base_path
+        self._renamed.add(current_path)
+        self._back_names[base_path] = current_path
+
+    def _remove_rename(self, current_path):
+        base_path = self.renames.pop(current_path)
+        self._renamed.remove(current_path)
+        if self._back_names.get(base_path) == current_path:
+            del self._back_names[base_path]
+        return base_path
 
     def write_content(self, full_path, file_mode, strings):
         self.overlay_content.add(full_path)
@@ -207,36 +1261,148 @@ class OverlayFileStore:
     def read_content(self, full_path):
         if full_path in self.overlay_content:
             return self.overlay.read_content(full_path)
-        return self.base.read_content(self._base_path(full_path))
+        return self.base.read_content(self._require_base_path(full_path))
+
+    def iter_content(self, full_path, chunk_size=CHUNK_SIZE):
+        if full_path in self.overlay_content:
+            return self.overlay.iter_content(full_path, chunk_size)
+        return self.base.iter_content(self._require_base_path(full_path),
+                                      chunk_size)
+
+    def map_content(self, full_path):
+        if full_path in self.overlay_content:
+            return self.overlay.map_content(full_path)
+        return self.base.map_content(self._require_base_path(full_path))
 
     def get_file_mode(self, full_path):
         if full_path in self.overlay_content:
             return self.overlay.get_file_mode(full_path)
-        return self.base.get_file_mode(self._base_path(full_path))
+        return self.base.get_file_mode(self._require_base_path(full_path))
+
+    def get_kind(self, full_path):
+        if full_path in self.overlay_content:
+            return self.overlay.get_kind(full_path)
+        return self.base.get_kind(self._require_base_path(full_path))
+
+    def copy_file(self, source_path, target_path):
+        # The target is only marked once the copy has succeeded, so that a
+        # failed copy leaves it untouched.
+        if source_path in self.overlay_content:
+            copied = self.overlay.copy_file(source_path, target_path)
+        else:
+            base_path = self._require_base_path(source_path)
+            content = self.base.iter_content(base_path)
+            copied = self.overlay.write_content(
+                target_path, self.base.get_file_mode(base_path), content)
+        self.overlay_content.add(target_path)
+        return copied
+
+    def _iter_base_roots(self, full_path):
+        """Emit the base paths of subtrees at or beneath full_path."""
+        base_root = self._forward_path(full_path)
+        if base_root is not None:
+            yield base_root
+        for key in self._renamed.iter_subpaths(full_path):
+            if key != full_path:
+                yield self.renames[key]
+
+    def _iter_base_subpaths(self, full_path):
+        """Emit current paths for base content at or beneath full_path."""
+        for base_root in self._iter_base_roots(full_path):
+            for base_path in self.base.iter_subpaths(base_root):
+                current_path = self._current_path(base_path)
+                if current_path is not None:
+                    yield current_path
+
+    def _iter_base_entries(self, full_path):
+        """Emit entries for base content at or beneath full_path.
+
+        Entries are as from iter_entries, with current paths.
+        """
+        for base_root in self._iter_base_roots(full_path):
+            for base_path, kind, mode in self.base.iter_entries(base_root):
+                current_path = self._current_path(base_path)
+                if current_path is not None:
+                    yield current_path, kind, mode
 
     def iter_subpaths(self, full_path):
-        all_keys = set(self.overlay_content)
-        all_keys.update(self.renames)
-        base_path = self._base_path(full_path)
-        base_subpaths = self.base.iter_subpaths(base_path)
-        all_keys.update(self._current_paths(base_subpaths))
-        for key in only_subpaths(full_path, all_keys):
+        seen = set(self.overlay_content.iter_subpaths(full_path))
+        for key in self.overlay.iter_subpaths(full_path):
             yield key
+        for key in only_subpaths(full_path,
+                                 self._iter_base_subpaths(full_path)):
+            if key not in seen:
+                seen.add(key)
+                yield key
+
+    def iter_entries(self, full_path):
+        """Emit (path, kind, mode) for each path emitted by iter_subpaths."""
+        seen = set(self.overlay_content.iter_subpaths(full_path))
+        for entry in self.overlay.iter_entries(full_path):
+            yield entry
+        # As only_subpaths.
+        prefix = os.path.join(full_path, '')
+        for entry in self._iter_base_entries(full_path):
+            key = entry[0]
+            if key != full_path and not key.startswith(prefix):
+                continue
+            if key not in seen:
+                seen.add(key)
+                yield entry
 
     def discard(self, full_path):
         self.overlay_content.add(full_path)
         self.overlay.discard(full_path)
 
+    def _clear(self, full_path):
+        """Forget the overlay content, renames and opaque paths at full_path.
+
+        Paths beneath full_path are forgotten too.  Base content renamed to
+        beneath full_path stays hidden.
+        """
+        for key in list(self.overlay_content.iter_subpaths(full_path)):
+            self.overlay_content.remove(key)
+            self.overlay.discard(key)
+        for key in list(self._renamed.iter_subpaths(full_path)):
+            # The back name is kept, so that the base path stays hidden.
+            del self.renames[key]
+            self._renamed.remove(key)
+        for key in list(self._opaque.iter_subpaths(full_path)):
+            self._opaque.remove(key)
+
     def rename(self, old_path, new_path):
+        if old_path == new_path:
+            return
         replace_l = len(old_path)
-        for key in list(self.overlay_content):
-            if key[:replace_l] != old_path:
-                continue
-            new_key = new_path + key[replace_l:]
+        base_path = self._base_path(old_path)
+        moved = [(key, self._remove_rename(key)) for key in
+                 list(self._renamed.iter_subpaths(old_path))]
+        moved_content = list(self.overlay_content.iter_subpaths(old_path))
+        for key in moved_content:
             self.overlay_content.remove(key)
-            self.overlay_content.add(new_key)
-            self.overlay.rename(key, new_key)
-        self.renames[new_path] = self.renames.pop(old_path, old_path)
+        moved_opaque = list(self._opaque.iter_subpaths(old_path))
+        for key in moved_opaque:
+            self._opaque.remove(key)
+        # Whiteouts beneath new_path shadowed the content being replaced, so
+        # they must not shadow the content being moved there.
+        self._clear(new_path)
+        for key in moved_content:
+            self.overlay_content.add(new_path + key[replace_l:])
+        try:
+            self.overlay.rename(old_path, new_path)
+        except KeyError:
+            # Nothing beneath old_path is in the overlay.
+            pass
+        for key in moved_opaque:
+            self._opaque.add(new_path + key[replace_l:])
+        for key, key_base_path in moved:
+            self._add_rename(new_path + key[replace_l:], key_base_path)
+        if base_path is not None:
+            self._add_rename(new_path, base_path)
+        else:
+            self._opaque.add(new_path)
+        # Hide any base content that old_path shadowed.
+        self._opaque.add(old_path)
 
 
 class ReadOnlyStoreTree(BaseTree):
@@ -248,25 +1414,41 @@ class ReadOnlyStoreTree(BaseTree):
     def _require_parent(self, full_path):
         parent = os.path.dirname(full_path)
         try:
-            self._file_store.read_content(parent)
+            kind = self._file_store.get_kind(parent)
         except NoSuchFile:
             raise NoParent
-        except IsDirectory:
-            pass
-        else:
+        if kind != DIRECTORY:
             raise ParentNotDir
 
     def iter_subpaths(self, path):
         for path in self._file_store.iter_subpaths(self.full_path(path)):
             yield self.relpath(path)
 
+    def iter_entries(self, path):
+        """Emit (path, kind, mode) for each path emitted by iter_subpaths."""
+        for path, kind, mode in self._file_store.iter_entries(
+                self.full_path(path)):
+            yield self.relpath(path), kind, mode
+
     def read_content(self, path):
         """Access content as iterable of strings."""
         return self._file_store.read_content(self.full_path(path))
 
+    def iter_content(self, path, chunk_size=CHUNK_SIZE):
+        """Access content as an iterable of chunks of at most chunk_size."""
+        return self._file_store.iter_content(self.full_path(path), chunk_size)
+
+    def map_content(self, path):
+        """Provide content as a read-only memoryview, without copying it."""
+        return self._file_store.map_content(self.full_path(path))
+
     def get_file_mode(self, path):
         return self._file_store.get_file_mode(self.full_path(path))
 
+    def get_kind(self, path):
+        """Return DIRECTORY or FILE, without accessing content."""
+        return self._file_store.get_kind(self.full_path(path))
+
     def make_subtree(self, path):
         return type(self)(self.full_path(path), self._file_store)
 
@@ -292,6 +1474,13 @@ class StoreTree(ReadOnlyStoreTree):
     def mkdir(self, path, file_mode):
         return self._file_store.mkdir(self.full_path(path), file_mode)
 
+    def copy_file(self, source_path, target_path):
+        """Copy a file's content and mode to a new path."""
+        full_target_path = self.full_path(target_path)
+        self._require_parent(full_target_path)
+        return self._file_store.copy_file(self.full_path(source_path),
+                                          full_target_path)
+
     def rmtree(self, path):
         full_path = self.full_path(path)
         for sub_path in list(self._file_store.iter_subpaths(full_path)):
@@ -300,7 +1489,7 @@ class StoreTree(ReadOnlyStoreTree):
     def mkdtemp(self):
         name = ''.join(random.choice('abcdefghijklmnopqrstuvwxyz')
                        for x in range(8))
-        name = 'transform-' + name
+        name = TEMP_PREFIX + name
         self.mkdir(name, 0o700)
         return name
 
@@ -310,6 +1499,208 @@ class StoreTree(ReadOnlyStoreTree):
         self._file_store.rename(self.full_path(old_path), full_new_path)
 
 
+class ObservedTree:
+    """A wrapper that reports the operations performed on a tree.
+
+    Each operation is counted under its method name, bytes passed to
+    write_content are counted as 'bytes_written', and renames passed to
+    apply_renames are counted as 'rename'.  All other attributes are those of
+    the wrapped tree.  Subtrees and temp trees are wrapped too, so that their
+    operations are also reported.
+
+    :param tree: The tree to wrap.
+    :param observer: A TransformObserver to report operations to.
+    """
+
+    def __init__(self, tree, observer):
+        self.tree = tree
+        self.observer = observer
+
+    def __getattr__(self, name):
+        return getattr(self.tree, name)
+
+    def _wrap(self, tree):
+        return ObservedTree(tree, self.observer)
+
+    def iter_subpaths(self, path):
+        self.observer.count('iter_subpaths')
+        return self.tree.iter_subpaths(path)
+
+    def iter_entries(self, path):
+        self.observer.count('iter_entries')
+        return self.tree.iter_entries(path)
+
+    def read_content(self, path):
+        self.observer.count('read_content')
+        return self.tree.read_content(path)
+
+    def iter_content(self, path, *args, **kwargs):
+        self.observer.count('iter_content')
+        return self.tree.iter_content(path, *args, **kwargs)
+
+    def map_content(self, path):
+        self.observer.count('map_content')
+        return self.tree.map_content(path)
+
+    def get_file_mode(self, path):
+        self.observer.count('get_file_mode')
+        return self.tree.get_file_mode(path)
+
+    def get_kind(self, path):
+        self.observer.count('get_kind')
+        return self.tree.get_kind(path)
+
+    def write_content(self, path, file_mode, strings):
+        self.observer.count('write_content')
+        written = self.tree.write_content(path, file_mode, strings)
+        self.observer.count('bytes_written', written)
+        return written
+
+    def mkdir(self, path, file_mode):
+        self.observer.count('mkdir')
+        return self.tree.mkdir(path, file_mode)
+
+    def copy_file(self, source_path, target_path):
+        self.observer.count('copy_file')
+        return self.tree.copy_file(source_path, target_path)
+
+    def mkdtemp(self):
+        self.observer.count('mkdtemp')
+        return self.tree.mkdtemp()
+
+    def rmtree(self, path):
+        self.observer.count('rmtree')
+        return self.tree.rmtree(path)
+
+    def rename(self, old_path, new_path):
+        self.observer.count('rename')
+        return self.tree.rename(old_path, new_path)
+
+    def _count_renames(self, renames):
+        for rename in renames:
+            self.observer.count('rename')
+            yield rename
+
+    def apply_renames(self, renames):
+        # Let the wrapped tree apply the renames, so that it may batch them.
+        self.tree.apply_renames(self._count_renames(renames))
+
+    def make_subtree(self, path):
+        return self._wrap(self.tree.make_subtree(path))
+
+    def make_temp_tree(self):
+        self.observer.count('mkdtemp')
+        return self._wrap(self.tree.make_temp_tree())
+
+    def readonly_version(self):
+        return self._wrap(self.tree.readonly_version())
+
+
+class BackgroundCleaner:
+    """Removes transforms' temp trees on a background thread.
+
+    Pass this as a TreeTransform's cleaner, and the transform will hand its
+    temp tree over for removal instead of removing it before returning from
+    __exit__.  Use it as a context manager, or call close(), to wait for
+    pending removals to finish.
+
+    The tree is modified from the background thread, so this is only
+    suitable for trees that are safe to modify concurrently, like FSTree.
+
+    :param max_pending: The maximum number of temp trees awaiting removal.
+        Submitting more blocks until the backlog has been reduced.
+    """
+
+    # The default age, in seconds, after which temp dirs are considered to
+    # have been abandoned.
+    ORPHAN_AGE = 24 * 60 * 60
+
+    def __init__(self, max_pending=16):
+        self._queue = Queue(max_pending)
+        # Exceptions raised while removing temp trees.
+        self.errors = []
+        self._thread = Thread(target=self._run, name='tree-transform-cleaner')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            tree, path = item
+            try:
+                tree.rmtree(path)
+            except Exception as e:
+                self.errors.append(e)
+
+    def submit(self, tree, path):
+        """Schedule path in tree for removal."""
+        self._queue.put((tree, path))
+
+    def reclaim(self, tree, min_age=ORPHAN_AGE):
+        """Schedule removal of temp dirs abandoned by crashed processes.
+
+        Temp dirs not modified for min_age seconds are assumed to have been
+        abandoned, so min_age must exceed the lifetime of any transform.
+        tree must provide iter_temp_dirs, like FSTree.  Returns the number of
+        temp dirs scheduled.
+        """
+        names = list(tree.iter_temp_dirs(min_age))
+        for name in names:
+            self.submit(tree, name)
+        return len(names)
+
+    def close(self):
+        """Wait for all pending removals, then stop the thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+class TransformObserver:
+    """Receives timings and counts from TreeTransforms and ObservedTrees.
+
+    Subclasses override the methods for what they wish to record.  The
+    methods may be called from threads other than the transform's, e.g. by
+    a BackgroundCleaner.
+    """
+
+    def phase(self, name, seconds):
+        """Report that a phase of work named name took seconds to run.
+
+        TreeTransform reports 'enter', 'create_file', 'generate_renames',
+        'apply_renames' and 'rmtree'.
+        """
+
+    def count(self, name, amount=1):
+        """Report amount more of what name counts."""
+
+
+class MetricsCollector(TransformObserver):
+    """An observer that accumulates everything it is told."""
+
+    def __init__(self):
+        # Total seconds spent in each phase.
+        self.timings = {}
+        # The number of times each phase was reported.
+        self.phase_counts = {}
+        self.counters = {}
+
+    def phase(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0) + seconds
+        self.phase_counts[name] = self.phase_counts.get(name, 0) + 1
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+
 class NotPending(Exception):
     """Raised when attempting to access the transform while inactive."""
 
@@ -346,6 +1737,318 @@ class InactiveTransform:
     def add(self, key):
         raise NotPending
 
+    def index(self, key):
+        raise NotPending
+
+    def find_index(self, key):
+        raise NotPending
+
+    def path_index(self, parent, name):
+        raise NotPending
+
+
+class NameTable(MutableMapping):
+    """Maps entry ids to (parent_id, name), storing the entries compactly.
+
+    Each id is given an integer id when first seen, whether as an entry or as
+    a parent, and entries are stored as columns indexed by integer id: the
+    integer id of the parent, and the name.
+
+    Existing ids ('e-' and a normalized path) are not stored as strings.
+    Instead, each is keyed by the integer id of its path's parent and its
+    path's last component, which is usually also its name, so the strings
+    are only built when asked for.  Other ids are kept in a dict.
+
+    The integer ids are exposed for callers that walk the table, and the
+    mapping methods are a thin layer that translates string ids.
+    """
+
+    # The integer id of 'e-.', the tree root.
+    ROOT = 0
+
+    def __init__(self):
+        # The integer id of each existing id's path parent, or -1.
+        self._path_parents = array('i', [-1])
+        # The last path component of each existing id, or the other id.
+        self._path_names = ['e-.']
+        # For each existing id, the integer ids of its path children.
+        self._path_children = {}
+        self._indexes = {}
+        # Directory path -> integer id, for recently used directories.
+        self._dir_cache = {}
+        # The integer id of each entry's parent, or -1 if it is no entry.
+        self._parents = array('i', [-1])
+        self._names = [None]
+        self._len = 0
+
+    def _add(self, path_parent, path_name):
+        index = len(self._names)
+        self._path_parents.append(path_parent)
+        self._path_names.append(path_name)
+        self._parents.append(-1)
+        self._names.append(None)
+        return index
+
+    def path_index(self, parent, name):
+        """Return the integer id of an existing id, assigning one if needed.
+
+        :param parent: The integer id of the path's parent.
+        :param name: The last component of the path.
+        """
+        children = self._path_children.get(parent)
+        if children is None:
+            children = self._path_children[parent] = {}
+        index = children.get(name)
+        if index is None:
+            index = children[name] = self._add(parent, name)
+        return index
+
+    def _path_lookup(self, path, create):
+        """Return the integer id of an existing id's path, or None."""
+        if path == '.':
+            return self.ROOT
+        head, sep, name = path.rpartition(os.sep)
+        parent = self._dir_lookup(head, create)
+        if parent is None:
+            return None
+        return self._child_index(parent, name, create)
+
+    def _dir_lookup(self, head, create):
+        """Return the integer id of a directory path, or None.
+
+        The ids of recently used directories are cached, so that looking up
+        their children, or their children's children, does not start from
+        the root.  Integer ids of paths are never discarded, so cached ids
+        stay valid.
+        """
+        if head == '':
+            return self.ROOT
+        cache = self._dir_cache
+        index = cache.get(head)
+        if index is not None:
+            return index
+        names = []
+        ancestor = head
+        while index is None:
+            ancestor, sep, name = ancestor.rpartition(os.sep)
+            names.append(name)
+            if ancestor == '':
+                index = self.ROOT
+            else:
+                index = cache.get(ancestor)
+        for name in reversed(names):
+            index = self._child_index(index, name, create)
+            if index is None:
+                return None
+        if len(cache) >= NAME_TABLE_DIR_CACHE_SIZE:
+            cache.clear()
+        cache[head] = index
+        return index
+
+    def _child_index(self, parent, name, create):
+        if create:
+            return self.path_index(parent, name)
+        children = self._path_children.get(parent)
+        if children is None:
+            return None
+        return children.get(name)
+
+    def index(self, file_id):
+        """Return the integer id for an id, assigning one if needed."""
+        if file_id[:2] == 'e-':
+            return self._path_lookup(file_id[2:], True)
+        index = self._indexes.get(file_id)
+        if index is None:
+            index = self._indexes[file_id] = self._add(-1, file_id)
+        return index
+
+    def find_index(self, file_id):
+        """Return the integer id for an id, or None if it has none."""
+        if file_id[:2] == 'e-':
+            return self._path_lookup(file_id[2:], False)
+        return self._indexes.get(file_id)
+
+    def get_path(self, index):
+        """Return the path of an existing id, or None for other ids."""
+        if index == self.ROOT:
+            return '.'
+        names = []
+        while index != self.ROOT:
+            if self._path_parents[index] == -1:
+                return None
+            names.append(self._path_names[index])
+            index = self._path_parents[index]
+        names.reverse()
+        return os.sep.join(names)
+
+    def get_id(self, index):
+        """Return the id for an integer id."""
+        path = self.get_path(index)
+        if path is None:
+            return self._path_names[index]
+        return 'e-' + path
+
+    def get_parent_index(self, index):
+        """Return the integer id of an entry's parent, or -1 if no entry."""
+        return self._parents[index]
+
+    def get_name(self, index):
+        """Return the name of an entry, by integer id."""
+        return self._names[index]
+
+    def is_in_place(self, index):
+        """Return True if an existing entry keeps its path parent and name."""
+        return (self._parents[index] == self._path_parents[index] and
+                self._names[index] == self._path_names[index])
+
+    def set_entry(self, index, parent, name):
+        """Set the parent and name of an entry, by integer ids."""
+        if self._parents[index] == -1:
+            self._len += 1
+        self._parents[index] = parent
+        if name == self._path_names[index]:
+            # Share the path's string, rather than keeping an equal copy.
+            name = self._path_names[index]
+        self._names[index] = name
+
+    def remove_entry(self, index):
+        """Remove an entry, by integer id."""
+        if self._parents[index] == -1:
+            raise KeyError(self.get_id(index))
+        self._parents[index] = -1
+        self._names[index] = None
+        self._len -= 1
+
+    def iter_indexes(self):
+        """Emit the integer id of every entry."""
+        for index, parent in enumerate(self._parents):
+            if parent != -1:
+                yield index
+
+    def _entry_index(self, file_id):
+        index = self.find_index(file_id)
+        if index is None or self._parents[index] == -1:
+            raise KeyError(file_id)
+        return index
+
+    def __contains__(self, file_id):
+        index = self.find_index(file_id)
+        return index is not None and self._parents[index] != -1
+
+    def __getitem__(self, file_id):
+        index = self._entry_index(file_id)
+        return self.get_id(self._parents[index]), self._names[index]
+
+    def get(self, file_id, default=None):
+        index = self.find_index(file_id)
+        if index is None or self._parents[index] == -1:
+            return default
+        return self.get_id(self._parents[index]), self._names[index]
+
+    def __setitem__(self, file_id, info):
+        parent_id, name = info
+        self.set_entry(self.index(file_id), self.index(parent_id), name)
+
+    def __delitem__(self, file_id):
+        self.remove_entry(self._entry_index(file_id))
+
+    def __iter__(self):
+        for index in self.iter_indexes():
+            yield self.get_id(index)
+
+    def __len__(self):
+        return self._len
+
+
+class ShardedStaging:
+    """Allocates paths for staging entries, spread across shard directories.
+
+    Entries are numbered in order of allocation, and each shard directory
+    holds at most shard_size entries, so that staging very many entries does
+    not produce one huge directory.  Shard directories are created as they
+    are needed.
+
+    :param tree: The tree that staged entries are renamed within.
+    :param prefix: The tree-relative path of the staging directory.
+    """
+
+    def __init__(self, tree, prefix, shard_size=STAGING_SHARD_SIZE,
+                 levels=STAGING_SHARD_LEVELS):
+        self.tree = tree
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.levels = levels
+        self._counter = count()
+
+    def allocate(self):
+        """Return an unused tree-relative path for a staged entry."""
+        serial = next(self._counter)
+        names = []
+        for level in range(self.levels):
+            serial, index = divmod(serial, self.shard_size)
+            names.append(index)
+        names.append(serial)
+        names.reverse()
+        path = self.prefix
+        for level, name in enumerate(names[:-1]):
+            path = os.path.join(path, str(name))
+            # A shard is first used by the first entry it contains.
+            if not any(names[level + 1:]):
+                self.tree.mkdir(path, 0o700)
+        return os.path.join(path, str(names[-1]))
+
+
+class RenamePlan:
+    """The renames needed to apply a TreeTransform, with statistics.
+
+    The statistics are available without staging anything.  Iterating
+    generates the renames lazily, like TreeTransform.iter_renames, and each
+    iteration generates them afresh.  A plan is only valid until its
+    transform is next changed.
+
+    :ivar removals: The number of renames moving entries out of place.
+    :ivar insertions: The number of renames moving entries into place.
+    :ivar staged_bytes: The number of bytes of new content staged.
+    :ivar max_depth: The greatest depth of any path renamed within the tree,
+        where top-level paths have depth 0, or None if there are no renames.
+    """
+
+    # The estimated cost of a rename, as a number of bytes written.
+    RENAME_COST = 64 * 1024
+
+    def __init__(self, transform, moved_ids):
+        self._transform = transform
+        self._moved_ids = moved_ids
+        self.removals = len(moved_ids) + len(transform._remove_ids)
+        self.insertions = len(moved_ids) + len(transform._new_contents_path)
+        self.staged_bytes = transform._staged_bytes
+        self.max_depth = max(self._iter_depths(), default=None)
+
+    def __iter__(self):
+        return self._transform._iter_renames(self._moved_ids)
+
+    def __len__(self):
+        return self.removals + self.insertions
+
+    def _iter_depths(self):
+        transform = self._transform
+        for index in self._moved_ids:
+            yield transform._index_to_path(index).count(os.sep)
+            yield transform._final_path_of(index).count(os.sep)
+        for file_id in transform._remove_ids:
+            yield transform._tree_id_to_path(file_id).count(os.sep)
+        for file_id in transform._new_contents_path:
+            yield transform.get_final_path(file_id).count(os.sep)
+
+    @property
+    def estimated_cost(self):
+        """Estimate the I/O cost of applying the plan, in bytes written.
+
+        Each rename is counted as RENAME_COST, and staged content, which must
+        be flushed to storage along with the renames, by its size.
+        """
+        return len(self) * self.RENAME_COST + self.staged_bytes
+
 
 class TreeTransform:
     """Apply FS tree changes atomically.
@@ -356,46 +2059,116 @@ class TreeTransform:
 
     Basically, filesytem operations are applied as normal, but to temporary
     copies of files.  On exit, the temporary copies are renamed into place.
+
+    :param cleaner: If supplied, a BackgroundCleaner used to remove the temp
+        tree, so that exiting does not wait for deleted contents to be
+        removed.
+    :param observer: If supplied, a TransformObserver to report the time
+        spent in each phase to, and the number of renames.  To also count
+        the operations on the tree, wrap it in an ObservedTree.
     """
 
-    def __init__(self, tree, write=True):
+    def __init__(self, tree, write=True, cleaner=None, observer=None):
         self.tree = tree
         self.write = write
+        self.cleaner = cleaner
+        self.observer = observer
         self.id_counter = count()
         self._mark_inactive()
 
     def _mark_inactive(self):
+        self._active = False
         self._name_info = InactiveTransform()
-        self._temp_tree = None
-        self._new_contents = None
+        self._staging = None
         self._new_contents_path = InactiveTransform()
+        self._staged_bytes = 0
         self.id_counter = InactiveTransform()
         self._remove_ids = InactiveTransform()
+        self._final_paths = InactiveTransform()
 
     def __enter__(self):
-        self._name_info = {}
-        self._temp_tree = self.tree.make_temp_tree()
-        self._temp_tree.mkdir('new', 0o700)
-        self._new_contents = self._temp_tree.make_subtree('new')
+        if self.observer is not None:
+            with observe_phase(self.observer, 'enter'):
+                return self._enter()
+        return self._enter()
+
+    def _enter(self):
+        self._active = True
+        self._name_info = NameTable()
+        self._final_paths = {}
         self._new_contents_path = {}
-        self._temp_tree.mkdir('old', 0o700)
-        self._old_contents = self._temp_tree.make_subtree('old')
+        self._staged_bytes = 0
         self._remove_ids = set()
         self.id_counter = count()
         return self
 
+    def _apply_observed(self):
+        """Apply the renames, reporting planning and applying separately."""
+        with observe_phase(self.observer, 'generate_renames'):
+            renames = list(self.generate_renames())
+        self.observer.count('renames', len(renames))
+        with observe_phase(self.observer, 'apply_renames'):
+            self.tree.apply_renames(renames)
+
     def __exit__(self, exc_type, exc_value, exc_traceback):
         if (exc_type, exc_value, exc_traceback) == (None, None, None):
             if self.write:
-                self.tree.apply_renames(self.generate_renames())
-        self.tree.rmtree(self._temp_tree.tree_root)
+                if self.observer is None:
+                    self.tree.apply_renames(self.iter_renames())
+                else:
+                    self._apply_observed()
+        if self._staging is not None:
+            temp_tree = self._staging[0]
+            temp_tree.close()
+            if self.cleaner is None:
+                if self.observer is None:
+                    self.tree.rmtree(temp_tree.tree_root)
+                else:
+                    with observe_phase(self.observer, 'rmtree'):
+                        self.tree.rmtree(temp_tree.tree_root)
+            else:
+                self.cleaner.submit(self.tree, temp_tree.tree_root)
         self._mark_inactive()
 
-    def _tree_path_to_id(self, path):
+    def _get_staging(self):
+        """Return the temp tree, and its staging areas for new and old content.
+
+        These are created on first use, so that transforms which stage
+        nothing do no filesystem work.  While inactive, they are all None.
+        """
+        if self._staging is None:
+            if not self._active:
+                return None, None, None
+            temp_tree = self.tree.make_temp_tree()
+            temp_path = self.tree.relpath(temp_tree.tree_root)
+            staging = [temp_tree]
+            for name in ('new', 'old'):
+                temp_tree.mkdir(name, 0o700)
+                staging.append(ShardedStaging(
+                    self.tree, os.path.join(temp_path, name)))
+            self._staging = tuple(staging)
+        return self._staging
+
+    @property
+    def _temp_tree(self):
+        return self._get_staging()[0]
+
+    @property
+    def _new_staging(self):
+        return self._get_staging()[1]
+
+    @property
+    def _old_staging(self):
+        return self._get_staging()[2]
+
+    def _normalize_tree_path(self, path):
         normpath = os.path.normpath(path)
-        if normpath.startswith('..'):
+        if normpath.startswith('..') or os.path.isabs(normpath):
             raise ValueError('Path outside tree.')
-        return 'e-{}'.format(normpath)
+        return normpath
+
+    def _tree_path_to_id(self, path):
+        return 'e-{}'.format(self._normalize_tree_path(path))
 
     def _tree_id_to_path(self, file_id):
         if file_id[:2] != 'e-':
@@ -406,14 +2179,30 @@ class TreeTransform:
         return 'n-{}-{}'.format(next(self.id_counter), name)
 
     def acquire_existing_id(self, path):
-        file_id = self._tree_path_to_id(path)
-        if path in {'.', ''} or file_id in self._name_info:
-            return file_id
-        if file_id not in self._name_info:
-            parent, name = os.path.split(path)
-            parent_id = self.acquire_existing_id(parent)
-            self.set_name_info(file_id, parent_id, name)
-        return file_id
+        return self._acquire_normalized(self._normalize_tree_path(path))
+
+    def acquire_existing_ids(self, paths):
+        """Acquire the ids of many existing paths.
+
+        Each path is normalized once, and its ancestors are looked up by
+        integer id, so siblings share the work of acquiring their parents.
+        Returns the ids in the order of paths.
+        """
+        return [self._acquire_normalized(self._normalize_tree_path(path))
+                for path in paths]
+
+    def _acquire_normalized(self, path):
+        """Acquire a normalized path, and any of its unacquired ancestors."""
+        if path == '.':
+            return 'e-.'
+        name_info = self._name_info
+        index = NameTable.ROOT
+        for name in path.split(os.sep):
+            parent = index
+            index = name_info.path_index(parent, name)
+            if name_info.get_parent_index(index) == -1:
+                self._set_entry(index, parent, name)
+        return 'e-' + path
 
     def get_name(self, file_id):
         info = self._name_info.get(file_id)
@@ -435,70 +2224,221 @@ class TreeTransform:
         return self._tree_path_to_id(parent)
 
     def set_name_info(self, file_id, parent_id, name):
-        self._name_info[file_id] = (parent_id, name)
+        name_info = self._name_info
+        # The parent is looked up first, as it is often the last id looked
+        # up, and the entry may be its child.
+        parent = name_info.index(parent_id)
+        self._set_entry(name_info.index(file_id), parent, name)
+
+    def _set_entry(self, index, parent, name):
+        """Set an entry's parent and name, by integer ids."""
+        name_info = self._name_info
+        if (name_info.get_parent_index(index) == parent and
+                name_info.get_name(index) == name):
+            return
+        name_info.set_entry(index, parent, name)
+        self._invalidate_final_paths(index)
+
+    def _invalidate_final_paths(self, index):
+        """Discard the cached final paths of an entry and its descendants.
+
+        The cache always holds the ancestors of any entry it holds, so it
+        holds no descendants of an entry that is not cached.  When the entry
+        is cached, the whole cache is discarded, since it is rebuilt lazily,
+        and the table does not track children.
+        """
+        if index in self._final_paths:
+            self._final_paths.clear()
 
     def get_final_path(self, file_id, parent_id=None, name=None):
         if None in {parent_id, name}:
-            try:
-                parent_id, name = self._name_info[file_id]
-            except KeyError:
-                return self._tree_id_to_path(file_id)
+            return self._resolve_final_path(file_id)
         if parent_id == 'e-.':
             return name
-        parent_path = self.get_final_path(parent_id)
-        return os.path.join(parent_path, name)
+        return os.path.join(self._resolve_final_path(parent_id), name)
+
+    def _resolve_final_path(self, file_id):
+        index = self._name_info.find_index(file_id)
+        if index is None:
+            return self._tree_id_to_path(file_id)
+        return self._resolve_index(index)
+
+    def _resolve_index(self, index):
+        """Determine an entry's final path, using and updating the cache.
 
-    def create_file(self, name, parent_id, contents):
+        This walks up the parent chain iteratively, stopping at the first
+        cached ancestor, so that deep trees do not exhaust the stack.
+        """
+        name_info = self._name_info
+        final_paths = self._final_paths
+        unresolved = []
+        while True:
+            path = final_paths.get(index)
+            if path is not None:
+                break
+            parent = name_info.get_parent_index(index)
+            if parent == -1:
+                path = self._index_to_path(index)
+                if len(unresolved) > 0:
+                    final_paths[index] = path
+                break
+            if len(unresolved) > len(name_info):
+                raise ValueError('Parent loop.')
+            unresolved.append((index, name_info.get_name(index)))
+            index = parent
+            if index == NameTable.ROOT:
+                path = ''
+                break
+        for index, name in reversed(unresolved):
+            path = os.path.join(path, name)
+            final_paths[index] = path
+        return path
+
+    def _index_to_path(self, index):
+        """Return the tree path of an existing id, by integer id."""
+        path = self._name_info.get_path(index)
+        if path is None:
+            raise ValueError('Invalid id.')
+        return path
+
+    def create_file(self, name, parent_id, contents, file_mode=0o644):
+        if self.observer is not None:
+            with observe_phase(self.observer, 'create_file'):
+                return self._create_file(name, parent_id, contents,
+                                         file_mode)
+        return self._create_file(name, parent_id, contents, file_mode)
+
+    def _create_file(self, name, parent_id, contents, file_mode):
         file_id = self.make_new_id(name)
         self.set_name_info(file_id, parent_id, name)
-        self._new_contents.write_content(file_id, None, contents)
-        full_path = self._new_contents.full_path(file_id)
-        self._new_contents_path[file_id] = full_path
+        staging_path = self._new_staging.allocate()
+        self._staged_bytes += self.tree.write_content(staging_path, file_mode,
+                                                      contents)
+        self._new_contents_path[file_id] = staging_path
+        return file_id
+
+    def copy_file(self, source_id, parent_id, name):
+        """Create a new file with the content and mode of source_id.
+
+        The source may be an existing file or one created by this transform.
+        Its content is copied immediately, by the tree's copy_file.
+        """
+        source_path = self._new_contents_path.get(source_id)
+        if source_path is None:
+            source_path = self._tree_id_to_path(source_id)
+        # Copy before registering the new id, so that a failed copy leaves
+        # no id without content.
+        staging_path = self._new_staging.allocate()
+        self._staged_bytes += self.tree.copy_file(source_path, staging_path)
+        file_id = self.make_new_id(name)
+        self.set_name_info(file_id, parent_id, name)
+        self._new_contents_path[file_id] = staging_path
         return file_id
 
     def delete(self, file_id):
         """Schedule a path to be deleted.
 
-        The file will be moved to the old_contents subtree on apply, and then
-        deleted with the rest of the temp dir on __exit__.
+        The file will be moved to the old contents staging area on apply, and
+        then deleted with the rest of the temp dir on __exit__.
         """
         self._remove_ids.add(file_id)
 
-    def _generate_remove_renames(self):
-        remove_renames = []
-        new_contents_path = dict(self._new_contents_path)
-        relative_new_contents = self.tree.relpath(self._new_contents.tree_root)
-        relative_old_contents = self.tree.relpath(self._old_contents.tree_root)
-        for file_id, (parent_id, name) in self._name_info.items():
-            if file_id in self._new_contents_path:
+    def _index_set(self, file_ids):
+        """Return the integer ids of those file_ids that have them."""
+        find_index = self._name_info.find_index
+        indexes = set(find_index(file_id) for file_id in file_ids)
+        indexes.discard(None)
+        return indexes
+
+    @staticmethod
+    def _add_by_depth(buckets, path, rename):
+        """Add a rename to the bucket for the depth of path."""
+        depth = path.count(os.sep)
+        while len(buckets) <= depth:
+            buckets.append([])
+        buckets[depth].append(rename)
+
+    def _find_moved_ids(self):
+        """Return the integer ids of entries needing renames of their own.
+
+        An existing entry needs no rename of its own when its parent and name
+        are unchanged, and its parent is not being removed.  The entry then
+        stays within its parent wherever the parent goes, so a subtree that
+        moves as a unit needs only one rename, and an entry whose ancestors
+        stay put is not moved at all.
+        """
+        name_info = self._name_info
+        new_contents = self._index_set(self._new_contents_path)
+        removed = self._index_set(self._remove_ids)
+        moved_ids = []
+        for index in name_info.iter_indexes():
+            if index in new_contents or index in removed:
                 continue
-            if file_id in self._remove_ids:
+            if (name_info.is_in_place(index) and
+                    name_info.get_parent_index(index) not in removed):
                 continue
-            old_path = self._tree_id_to_path(file_id)
-            new_path = os.path.join(relative_new_contents, file_id)
-            remove_renames.append((old_path, new_path))
-            new_contents_path[file_id] = new_path
+            moved_ids.append(index)
+        return moved_ids
+
+    def _generate_remove_renames(self, moved_ids):
+        """Return removal renames bucketed by depth, and the staged paths.
+
+        The staged paths are keyed by integer id.
+        """
+        remove_renames = []
+        find_index = self._name_info.find_index
+        new_contents_path = dict(
+            (find_index(file_id), path)
+            for file_id, path in self._new_contents_path.items())
+        if len(moved_ids) == 0 and len(self._remove_ids) == 0:
+            # Avoid creating the temp tree when nothing needs moving.
+            return remove_renames, new_contents_path
+        new_staging = self._new_staging
+        old_staging = self._old_staging
+        for index in moved_ids:
+            old_path = self._index_to_path(index)
+            new_path = new_staging.allocate()
+            self._add_by_depth(remove_renames, old_path, (old_path, new_path))
+            new_contents_path[index] = new_path
         for file_id in self._remove_ids:
             old_path = self._tree_id_to_path(file_id)
-            new_path = os.path.join(relative_old_contents, file_id)
-            remove_renames.append((old_path, new_path))
-        # Always remove children before parents
-        remove_renames.sort(key=lambda p: p[0], reverse=True)
+            new_path = old_staging.allocate()
+            self._add_by_depth(remove_renames, old_path, (old_path, new_path))
         return remove_renames, new_contents_path
 
+    def _final_path_of(self, index):
+        """Return an entry's final path, caching only its ancestors'."""
+        name_info = self._name_info
+        parent = name_info.get_parent_index(index)
+        name = name_info.get_name(index)
+        if parent == NameTable.ROOT:
+            return name
+        return os.path.join(self._resolve_index(parent), name)
+
     def _generate_insert_renames(self, new_contents_path):
+        """Return insertion renames bucketed by depth."""
         insert_renames = []
-        for file_id, (parent_id, name) in self._name_info.items():
-            old_path = new_contents_path.get(file_id)
+        for index in self._name_info.iter_indexes():
+            old_path = new_contents_path.get(index)
             if old_path is None:
                 continue
-            new_path = self.get_final_path(file_id, parent_id, name)
-            insert_renames.append((old_path, new_path))
-        insert_renames.sort(key=lambda p: p[1])
+            new_path = self._final_path_of(index)
+            self._add_by_depth(insert_renames, new_path, (old_path, new_path))
         return insert_renames
 
-    def generate_renames(self):
-        """Generate renames for updating tree.
+    def _iter_renames(self, moved_ids):
+        remove_renames, new_contents_path = self._generate_remove_renames(
+            moved_ids)
+        for bucket in reversed(remove_renames):
+            for rename in bucket:
+                yield rename
+        del remove_renames
+        for bucket in self._generate_insert_renames(new_contents_path):
+            for rename in bucket:
+                yield rename
+
+    def iter_renames(self):
+        """Generate renames for updating tree, lazily.
 
         Removals are always in child-to-parent order, because removing
         something before its children generally fails.
@@ -506,10 +2446,25 @@ class TreeTransform:
         Similarly, insertions are always in parent-to-child order, because
         creating something before its parent generally fails.
 
+        Both are grouped by depth, which is all that these orders require, so
+        the renames are produced in linear time, and renames at the same depth
+        are adjacent, so they can be batched by iter_rename_batches.
+        Insertions are not planned until the removals have been consumed.
+
         Actual renames are decomposed into a removal and an insertion.  This
         handles certain corner cases nicely, e.g. if the parent and child swap
         places.
+
+        Entries that remain in their current parent under their current name
+        are not renamed at all, so a directory that moves as a unit is renamed
+        once, and entries acquired only to serve as parents stay put.
+        """
+        return self._iter_renames(self._find_moved_ids())
+
+    def generate_renames(self):
+        """Return a RenamePlan for updating tree.
+
+        The plan describes the renames before any are generated, so callers
+        can decide how, or whether, to apply them.  See iter_renames.
         """
-        remove_renames, new_contents_path = self._generate_remove_renames()
-        insert_renames = self._generate_insert_renames(new_contents_path)
-        return remove_renames + insert_renames
+        return RenamePlan(self, self._find_moved_ids())